@@ -2,13 +2,19 @@ import argparse
 
 import os
 
+from image_conversion import CONVERSION_METHODS, DEFAULT_THRESHOLD
+from image_generator import FONT_PATH
+from label_rasterizer import DEFAULT_TRIM_MARGIN, DOTS_PER_INCH
+
 PATH = os.path.dirname(__file__)
 
 
 def set_args() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description='Label Maker for PT-P710BT')
-    parser.add_argument('bt_address', nargs='?', help='Bluetooth address of device (eg. "EC:79:49:63:2A:80")')
+    parser.add_argument('bt_address', nargs='?', help='Bluetooth address of device (eg. "EC:79:49:63:2A:80"), '
+                                                              'or "tcp:HOST:PORT" for the printer simulator')
     parser.add_argument('--image', type=str, help='Path to image to print')
+    add_label_args(parser)
     parser.add_argument('--bt-channel', type=int, default=1, help='Bluetooth Channel to use')
     parser.add_argument('--set-default', action='store_true', help='Store the `bt_address` value as the default for '
                                                                    'future executions of the script')
@@ -16,6 +22,53 @@ def set_args() -> argparse.ArgumentParser:
     return parser
 
 
+def add_label_args(parser):
+    """The options describing the labels of a job, shared with the spool compiler"""
+    parser.add_argument('--batch', type=str, nargs='+', metavar='IMAGE',
+                        help='Paths to images to print as one chained job')
+    parser.add_argument('--text', type=str, nargs='+',
+                        help='Texts to render and print as one chained job, one label per text')
+    parser.add_argument('--no-cut', type=int, nargs='*', metavar='LABEL',
+                        help='Numbers (starting at 1) of the labels not to cut after, all labels if none are given')
+    parser.add_argument('--template', type=str, help='Path to a JSON or YAML label template to print')
+    parser.add_argument('--field', type=str, action='append', metavar='NAME=VALUE',
+                        help='Value of a template field, can be given several times')
+    add_rendering_args(parser)
+
+
+def add_rendering_args(parser):
+    """The options describing how texts and images are turned into labels, shared with the daemon and MQTT listener"""
+    parser.add_argument('--font', type=str, default=FONT_PATH, help='Path to the TrueType font to render texts with')
+    parser.add_argument('--max-length', type=float,
+                        help='Longest label in mm, longer texts are wrapped over more lines and shrunk to fit')
+    parser.add_argument('--max-lines', type=int, help='Most lines to wrap texts over')
+    add_conversion_args(parser)
+    add_trim_args(parser)
+
+
+def add_conversion_args(parser):
+    parser.add_argument('--conversion', type=str, choices=CONVERSION_METHODS, default='auto',
+                        help='How image pixels are turned into dots: by alpha channel, by brightness threshold, or '
+                             'dithered for photos and greyscale scans. auto uses the alpha channel of images with '
+                             'transparent pixels, and the threshold otherwise')
+    parser.add_argument('--threshold', type=int, default=DEFAULT_THRESHOLD,
+                        help='Brightness (0-255) below which pixels are printed with the threshold conversion')
+    parser.add_argument('--fit', action='store_true',
+                        help='Scale images to the height of the tape instead of requiring the exact height')
+
+
+def add_trim_args(parser):
+    parser.add_argument('--no-trim', action='store_true',
+                        help='Print the blank columns at both ends of images and texts instead of trimming them')
+    parser.add_argument('--trim-margin', type=float,
+                        help=f"Blank space in mm kept before and after the ink when trimming "
+                             f"({DEFAULT_TRIM_MARGIN * 25.4 / DOTS_PER_INCH:.1f}). Also trims --image, which is "
+                             f"otherwise streamed to the printer as it is read")
+    parser.add_argument('--min-length', type=float,
+                        help='Shortest label in mm, trimmed labels get blank space back to reach it. Also trims '
+                             '--image')
+
+
 def parse():
     parser = set_args()
     return parser.parse_args()
\ No newline at end of file
@@ -2,18 +2,48 @@ import argparse
 
 import os
 
+import app_args
+from label_cache import DEFAULT_PAYLOAD_CACHE_SIZE
+from print_scheduler import DEFAULT_DEDUP_WINDOW
+from print_worker import DEFAULT_QUEUE_SIZE
+from render_pool import DEFAULT_RENDER_WORKERS
+
 PATH = os.path.dirname(__file__)
 
 
 def set_args() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description='Label Maker for PT-P710BT')
-    parser.add_argument('bt_address', nargs='?', help='Bluetooth address of device (eg. "EC:79:49:63:2A:80")')
+    parser.add_argument('bt_address', nargs='*', help='Bluetooth addresses of the printers to spread the labels over '
+                                                      '(eg. "EC:79:49:63:2A:80"), or "tcp:HOST:PORT" for the printer '
+                                                      'simulator')
     parser.add_argument('--mqtt-host', type=str, help='URL to MQTT broker')
     parser.add_argument('--mqtt-port', type=int, help='Port to MQTT broker')
     parser.add_argument('--mqtt-user', type=str, help='User of MQTT broker')
     parser.add_argument('--mqtt-password', type=str, help='Password of MQTT broker')
+    parser.add_argument('--template', type=str,
+                        help='Path to a JSON or YAML label template, messages are then JSON objects with the '
+                             'values of its fields')
+    app_args.add_rendering_args(parser)
+    parser.add_argument('--topic', type=str, default='label/print', help='MQTT topic to receive print jobs on')
+    parser.add_argument('--result-topic', type=str, default='label/result',
+                        help='MQTT topic to report the state and timings of every job on')
+    parser.add_argument('--template-dir', type=str,
+                        help='Directory with JSON label templates that messages can pick by name')
     parser.add_argument('--bt-channel', type=int, default=1, help='Bluetooth Channel to use')
-    parser.add_argument('--set-default', action='store_true', help='Store the `bt_address` value as the default for '
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='Number of labels that can wait for the printer before new messages are dropped')
+    parser.add_argument('--dedup-window', type=float, default=DEFAULT_DEDUP_WINDOW,
+                        help='Seconds an identical label is merged into a waiting one as an extra copy, 0 to never '
+                             'merge')
+    parser.add_argument('--stats-topic', type=str, default='label/stats',
+                        help='MQTT topic to publish the queue metrics on after every job')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_PAYLOAD_CACHE_SIZE,
+                        help='Number of rendered labels to keep in memory, so repeated texts are not rendered again')
+    parser.add_argument('--render-workers', type=int, default=DEFAULT_RENDER_WORKERS,
+                        help='Number of processes rendering queued labels ahead of the printers, 0 to render each '
+                             'label when its printer is ready')
+    parser.add_argument('--cache-dir', type=str, help='Directory to also store rendered labels in')
+    parser.add_argument('--set-default', action='store_true', help='Store the `bt_address` values as the default for '
                                                                    'future executions of the script')
     parser.add_argument('-i', '--info', action='store_true', help="Fetch information from the printer")
     return parser
@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import socket
+
+from label_commands import MAX_WRITE_SIZE, CommandBuilder, build_label_job
+from label_maker import TCP_ADDRESS_PREFIX, ConnectionState, PrinterError, StatusType, parse_status_information, \
+    socket_address
+from label_rasterizer import DEFAULT_TRIM, TZE_DOTS, compress, encode_image, trim_stats
+from printer_state import DEFAULT_STATUS_TTL, PrinterState
+
+DEFAULT_STATUS_TIMEOUT = 10
+DEFAULT_PRINT_TIMEOUT = 120
+DEFAULT_RETRY_DELAY = 5
+
+
+class AsyncPrinter:
+    """
+    asyncio driver for one printer
+
+    Status packets are read by a background task for as long as the printer is connected, so they are handled while
+    raster data is being sent. Any number of printers can be driven from one event loop.
+    """
+
+    def __init__(self, address, channel=1, status_timeout=DEFAULT_STATUS_TIMEOUT,
+                 print_timeout=DEFAULT_PRINT_TIMEOUT, status_ttl=DEFAULT_STATUS_TTL):
+        """
+        :param address: Bluetooth address of the printer, or "tcp:HOST:PORT" for the printer simulator
+        :param channel: Bluetooth channel to use
+        :param status_timeout: Seconds to wait for a reply to a status request
+        :param print_timeout: Seconds to wait for a job to be printed
+        :param status_ttl: Seconds the cached printer status is trusted, None to only refresh it after an event
+        """
+        self.address = address
+        self.channel = channel
+        self.status_timeout = status_timeout
+        self.print_timeout = print_timeout
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.subscribers = set()
+        self.state = PrinterState(status_ttl)
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @property
+    def media_width(self):
+        """Last known tape width in mm"""
+        return self.state.media_width
+
+    @property
+    def connected(self):
+        return self.reader_task is not None and not self.reader_task.done()
+
+    async def connect(self, retry_delay=DEFAULT_RETRY_DELAY, attempts=None):
+        """
+        Connect to the printer, retrying every `retry_delay` seconds
+
+        :param attempts: Number of attempts before giving up, None to keep trying
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self.reader, self.writer = await self._open_connection()
+                break
+            except OSError as error:
+                if attempts is not None and attempt >= attempts:
+                    raise
+                print(f"Could not connect to {self.address}: {error}; Retrying in {retry_delay}s...")
+                await asyncio.sleep(retry_delay)
+
+        self.reader_task = asyncio.create_task(self._read_status())
+
+    async def _open_connection(self):
+        address = socket_address(self.address, self.channel)
+        if self.address.startswith(TCP_ADDRESS_PREFIX):
+            return await asyncio.open_connection(*address)
+
+        if not hasattr(socket, "AF_BLUETOOTH"):
+            raise OSError("This Python has no Bluetooth socket support")
+
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+        sock.setblocking(False)
+        try:
+            await asyncio.get_running_loop().sock_connect(sock, address)
+        except OSError:
+            sock.close()
+            raise
+        return await asyncio.open_connection(sock=sock)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+        if self.reader_task is not None:
+            await self.reader_task
+            self.reader_task = None
+
+    async def _read_status(self):
+        """Read status packets until the connection closes, and hand them to every subscriber"""
+        try:
+            while True:
+                status = parse_status_information(await self.reader.readexactly(32))
+                self.state.update(status)
+                for queue in list(self.subscribers):
+                    queue.put_nowait(status)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self.state.invalidate()
+            for queue in list(self.subscribers):
+                queue.put_nowait(None)
+
+    async def events(self):
+        """
+        Iterate over every status packet the printer sends, until the connection closes
+
+        Packets are parsed into StatusInformation, e.g. `async for status in printer.events()`.
+        """
+        queue = asyncio.Queue()
+        self.subscribers.add(queue)
+        try:
+            while True:
+                status = await queue.get()
+                if status is None:
+                    break
+                yield status
+        finally:
+            self.subscribers.discard(queue)
+
+    async def _wait_for(self, queue, status_types, timeout):
+        async def wait():
+            while True:
+                status = await queue.get()
+                if status is None:
+                    raise ConnectionError(f"Connection to {self.address} closed")
+                if status.status_type in status_types:
+                    return status
+
+        return await asyncio.wait_for(wait(), timeout)
+
+    async def _write(self, data):
+        """Write in MTU-sized pieces, giving the status reader a chance to run in between"""
+        view = memoryview(data)
+        for start in range(0, len(view), MAX_WRITE_SIZE):
+            self.writer.write(view[start:start + MAX_WRITE_SIZE])
+            await self.writer.drain()
+
+    async def status(self):
+        """Request the printer status, returns StatusInformation"""
+        async with self.lock:
+            queue = asyncio.Queue()
+            self.subscribers.add(queue)
+            try:
+                await self._write(CommandBuilder().invalidate().initialize().status_information_request().getvalue())
+                return await self._wait_for(queue, (StatusType.REPLY_TO_STATUS_REQUEST,), self.status_timeout)
+            finally:
+                self.subscribers.discard(queue)
+
+    async def print_label(self, image, cut=True):
+        """
+        Print one label
+
+        :param image: Anything `encode_image` accepts, e.g. a path or a PIL image
+        :return: ConnectionState.DONE, or ConnectionState.DISCONNECTED if the printer turned off
+        """
+        return await self.print_labels([(image, cut)])
+
+    async def print_labels(self, labels, chain_printing=False, trim=DEFAULT_TRIM, conversion=None):
+        """
+        Print several labels as one job
+
+        Encoding runs in the default executor, so other printers on the event loop keep going meanwhile.
+
+        :param labels: List of (image, cut) tuples, `cut` tells whether to cut after that label
+        :param trim: How to trim the blank columns at both ends of the labels, None to print every column
+        :param conversion: How the pixels are turned into dots, see image_conversion.Conversion
+        :return: ConnectionState.DONE, or ConnectionState.DISCONNECTED if the printer turned off
+        """
+        if self.state.is_stale():
+            await self.status()
+
+        dots = TZE_DOTS[self.media_width]
+        pages = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: [(compress(encode_image(image, dots, conversion), trim), cut) for image, cut in labels])
+        job = build_label_job(pages, self.media_width, chain_printing)
+
+        async with self.lock:
+            queue = asyncio.Queue()
+            self.subscribers.add(queue)
+            try:
+                await self._write(CommandBuilder().invalidate().initialize().getvalue())
+                await self._write(job.getvalue())
+                trim_stats.record_pages(pages)
+
+                completed = 0
+                while completed < len(pages):
+                    status = await self._wait_for(queue, (StatusType.PRINTING_COMPLETED, StatusType.ERROR_OCCURRED,
+                                                          StatusType.TURNED_OFF), self.print_timeout)
+                    if status.status_type == StatusType.ERROR_OCCURRED:
+                        raise PrinterError(status)
+                    if status.status_type == StatusType.TURNED_OFF:
+                        return ConnectionState.DISCONNECTED
+                    completed += 1
+            finally:
+                self.subscribers.discard(queue)
+
+        return ConnectionState.DONE
+
+
+async def print_on_all(addresses, images, channel=1):
+    """Print the same images on several printers at once"""
+    async def print_on(address):
+        async with AsyncPrinter(address, channel) as printer:
+            status = await printer.status()
+            print(f"{address}: {status.media_width}mm tape")
+            state = await printer.print_labels([(image, True) for image in images])
+            print(f"{address}: {state.name}")
+
+    await asyncio.gather(*(print_on(address) for address in addresses))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print on one or more PT-P710BT printers with asyncio')
+    parser.add_argument('addresses', nargs='+', help='Bluetooth addresses of the printers, or "tcp:HOST:PORT"')
+    parser.add_argument('--image', type=str, nargs='+', required=True, help='Paths to images to print')
+    parser.add_argument('--bt-channel', type=int, default=1, help='Bluetooth Channel to use')
+    options = parser.parse_args()
+
+    asyncio.run(print_on_all(options.addresses, options.image, options.bt_channel))
+
+
+if __name__ == "__main__":
+    main()
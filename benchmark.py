@@ -0,0 +1,402 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+import numpy as np
+import packbits
+import png
+
+from image_conversion import CONVERSION_METHODS, Conversion
+from label_commands import build_label_job, send_buffer
+from label_rasterizer import CHUNK_SIZE, PRINT_HEAD_DOTS, RASTER_COMMAND, TZE_DOTS, ZERO_CHUNK, ZERO_COMMAND, \
+    compress, compress_line, encode_image, encode_png, stream_png
+
+LABEL_LENGTHS = (500, 2000, 8000)
+CONTENT_KINDS = ('text', 'dense', 'sparse')
+STAGES = ('render', 'encode', 'rasterize', 'commands', 'send')
+
+
+def legacy_encode_png(image_path, target_height):
+    """The original per-pixel bit stuffing encoder, kept as the reference for output and timing"""
+    margin = (128 - target_height) // 2
+
+    with open(image_path, 'rb') as fd:
+        width, height, rows, info = png.Reader(file=fd).asRGBA()
+        data = [row[3::4] for row in rows]
+    data = list(zip(*data))
+
+    buffer = bytearray()
+
+    byte = 0
+    bits = 0
+    for line in data:
+        for _ in range(0, margin):
+            bits += 1
+
+            if bits == 8:
+                buffer.append(byte)
+                bits = 0
+                byte = 0
+
+        for v in line:
+            if v > 0:
+                byte |= (1 << (7 - bits))
+            bits += 1
+
+            if bits == 8:
+                buffer.append(byte)
+                bits = 0
+                byte = 0
+
+        for _ in range(0, margin):
+            bits += 1
+
+            if bits == 8:
+                buffer.append(byte)
+                bits = 0
+                byte = 0
+
+    return buffer
+
+
+def legacy_rasterize(encoded_image_data):
+    """The original rasterizer, packing every line twice with packbits, kept as the reference for output and timing"""
+    for i in range(0, len(encoded_image_data), CHUNK_SIZE):
+        buffer = bytearray()
+        chunk = encoded_image_data[i:i + CHUNK_SIZE]
+
+        if chunk == ZERO_CHUNK:
+            buffer += ZERO_COMMAND
+        else:
+            packed_chunk = packbits.encode(chunk)
+
+            buffer += RASTER_COMMAND
+            buffer += len(packed_chunk).to_bytes(2, "little")
+            buffer += packbits.encode(chunk)
+
+        yield buffer
+
+
+def write_random_png(path, width, height, seed=0):
+    """Write an RGBA PNG with random alpha values"""
+    rng = random.Random(seed)
+    rows = [[value for _ in range(width) for value in (0, 0, 0, rng.choice((0, 0, 255)))] for _ in range(height)]
+    with open(path, 'wb') as fd:
+        png.Writer(width, height, greyscale=False, alpha=True).write(fd, rows)
+
+
+def time_call(function, *args, repeat=3):
+    return min(timeit.repeat(lambda: function(*args), number=1, repeat=repeat))
+
+
+def bench_encoder(lengths=LABEL_LENGTHS, repeat=3):
+    """Compare the legacy and the vectorized PNG encoder for every tape width"""
+    print(f"{'dots':>5} {'length':>7} {'legacy (ms)':>12} {'numpy (ms)':>11} {'speedup':>8}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for dots in sorted(set(TZE_DOTS.values())):
+            for length in lengths:
+                path = os.path.join(directory, f"{dots}x{length}.png")
+                write_random_png(path, length, dots)
+
+                if legacy_encode_png(path, dots) != encode_png(path, dots):
+                    raise AssertionError(f"Encoded output differs for {dots} dots, {length} columns")
+
+                legacy = time_call(legacy_encode_png, path, dots, repeat=repeat)
+                vectorized = time_call(encode_png, path, dots, repeat=repeat)
+
+                print(f"{dots:>5} {length:>7} {legacy * 1000:>12.1f} {vectorized * 1000:>11.1f} "
+                      f"{legacy / vectorized:>7.1f}x")
+
+
+def write_photo_png(path, width, height, seed=0):
+    """Write an RGBA PNG like a scanned photo: a brightness gradient with noise, and some transparent pixels"""
+    rng = np.random.default_rng(seed)
+    grey = np.linspace(0, 255, width)[np.newaxis, :] + rng.normal(0, 40, (height, width))
+    grey = np.clip(grey, 0, 255).astype(np.uint8)
+    alpha = np.where(rng.random((height, width)) < 0.1, 0, 255).astype(np.uint8)
+    pixels = np.stack([grey, grey, grey, alpha], axis=2)
+    with open(path, 'wb') as fd:
+        png.Writer(width, height, greyscale=False, alpha=True).write(fd, pixels.reshape(height, width * 4))
+
+
+def bench_conversion(lengths=LABEL_LENGTHS, repeat=3):
+    """Compare the PNG alpha encoder with the Pillow input stage and every conversion method on 24mm labels"""
+    methods = [method for method in CONVERSION_METHODS if method != 'auto']
+    print(f"{'length':>7} {'png alpha (ms)':>15} " + " ".join(f"{method + ' (ms)':>20}" for method in methods))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for length in lengths:
+            path = os.path.join(directory, f"{length}.png")
+            write_photo_png(path, length, PRINT_HEAD_DOTS)
+
+            if encode_png(path, PRINT_HEAD_DOTS) != encode_image(path, PRINT_HEAD_DOTS, Conversion('alpha')):
+                raise AssertionError(f"Alpha conversion differs from the PNG encoder for {length} columns")
+
+            current = time_call(encode_png, path, PRINT_HEAD_DOTS, repeat=repeat)
+            times = [time_call(encode_image, path, PRINT_HEAD_DOTS, Conversion(method), repeat=repeat)
+                     for method in methods]
+
+            print(f"{length:>7} {current * 1000:>15.1f} " + " ".join(f"{seconds * 1000:>20.1f}" for seconds in times))
+
+
+def bench_rasterizer(lengths=LABEL_LENGTHS, kinds=('sparse', 'dense'), repeat=3):
+    """Compare the original rasterizer with the single pass compressor on 24mm labels"""
+    print(f"{'content':>8} {'length':>7} {'legacy (ms)':>12} {'compress (ms)':>14} {'speedup':>8}")
+
+    for kind in kinds:
+        for length in lengths:
+            data = encode_image(make_content(kind, PRINT_HEAD_DOTS, length), PRINT_HEAD_DOTS)
+
+            if b"".join(legacy_rasterize(data)) != compress(data).raster:
+                raise AssertionError(f"Compressed output differs for {kind} content, {length} columns")
+
+            legacy = time_call(lambda: b"".join(legacy_rasterize(data)), repeat=repeat)
+            # Start without cached lines, so repeated runs don't just measure the cache
+            single_pass = time_call(lambda: compress_line.cache_clear() or compress(data), repeat=repeat)
+
+            print(f"{kind:>8} {length:>7} {legacy * 1000:>12.1f} {single_pass * 1000:>14.1f} "
+                  f"{legacy / single_pass:>7.1f}x")
+
+
+def bench_streaming(lengths=LABEL_LENGTHS):
+    """
+    Compare peak memory and time to the first raster data of the streaming and the whole image encoder
+
+    The streaming peak is not flat: PNG rows run across the raster lines, so the whole image is kept as one bit per
+    pixel (16 bytes per column on 24mm tape). On top of that come the bounded decompression blocks and the
+    compress_line cache, which fills up with the first 4096 different lines.
+    """
+    print(f"{'length':>7} {'whole peak (KiB)':>17} {'stream peak (KiB)':>18} {'whole first (ms)':>17} "
+          f"{'stream first (ms)':>18}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for length in lengths:
+            path = os.path.join(directory, f"{length}.png")
+            write_random_png(path, length, PRINT_HEAD_DOTS)
+
+            def whole():
+                start = timeit.default_timer()
+                raster = compress(encode_png(path, PRINT_HEAD_DOTS)).raster
+                return timeit.default_timer() - start, hashlib.sha256(raster).digest()
+
+            def streamed():
+                # Only a digest of the blocks is kept, like a socket they are sent to, so the peak is the encoder's
+                start = timeit.default_timer()
+                _, _, blocks = stream_png(path, PRINT_HEAD_DOTS)
+                digest = hashlib.sha256(next(blocks))
+                first_seconds = timeit.default_timer() - start
+                for block in blocks:
+                    digest.update(block)
+                return first_seconds, digest.digest()
+
+            (whole_first, whole_raster), _, whole_peak = measure(whole, 1)
+            (stream_first, stream_raster), _, stream_peak = measure(streamed, 1)
+
+            if whole_raster != stream_raster:
+                raise AssertionError(f"Streamed output differs for {length} columns")
+
+            print(f"{length:>7} {whole_peak / 1024:>17.1f} {stream_peak / 1024:>18.1f} {whole_first * 1000:>17.1f} "
+                  f"{stream_first * 1000:>18.1f}")
+
+
+class FakeSocket:
+    """Stands in for the printer's socket and records everything sent to it"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.writes = 0
+
+    def send(self, data):
+        self.data += data
+        self.writes += 1
+        return len(data)
+
+
+def make_content(kind, dots, length, seed=0):
+    """
+    Create the source of a label
+
+    :param kind: 'text' for a rendered text (returns the text), 'dense' for random dots or 'sparse' for a blank label
+                 with a mark every 200 columns (returns an alpha array)
+    """
+    if kind == 'text':
+        # Characters are roughly a quarter of the tape height wide with the default font sizes
+        text = "ASSET-0123456789 " * (length // 4 + 1)
+        return text[:max(1, length * 4 // dots)].strip()
+
+    rng = np.random.default_rng(seed)
+    if kind == 'dense':
+        return (rng.random((dots, length)) < 0.5).astype(np.uint8) * 255
+
+    alpha = np.zeros((dots, length), dtype=np.uint8)
+    alpha[:, ::200] = 255
+    return alpha
+
+
+def clear_caches():
+    """Forget the fonts, text lines, run widths and compressed raster lines earlier runs cached"""
+    from label_cache import font_cache
+    from text_layout import line_cache, measure_run
+
+    font_cache.clear()
+    line_cache.clear()
+    measure_run.cache_clear()
+    compress_line.cache_clear()
+
+
+def measure(function, repeat, warm=False):
+    """
+    Best wall time of `repeat` runs, and the peak memory of one extra traced run
+
+    The peak only counts memory allocated by Python, not the pixel buffers of PIL images.
+
+    :param warm: Keep what earlier runs cached, otherwise every run starts with empty caches
+    """
+    if not warm:
+        cached = function
+        function = lambda: clear_caches() or cached()
+    seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+
+    tracemalloc.start()
+    result = function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, seconds, peak
+
+
+def bench_pipeline(lengths=LABEL_LENGTHS, kinds=CONTENT_KINDS, repeat=3, warm=False):
+    """
+    Time every stage from rendering a label to the bytes sent to the printer
+
+    Every run starts with empty caches by default, like the first label of a kind. With `warm` the runs reuse what the
+    earlier ones cached, like a repeated label.
+
+    :return: One result per tape width, label length and content kind
+    """
+    from image_generator import text_to_image
+
+    media_widths = {dots: width for width, dots in TZE_DOTS.items()}
+    results = []
+
+    for dots in sorted(media_widths):
+        for length in lengths:
+            for kind in kinds:
+                stages = {}
+                source = make_content(kind, dots, length)
+
+                if kind == 'text':
+                    source, seconds, peak = measure(lambda: text_to_image(source, dots), repeat, warm)
+                    stages['render'] = {'seconds': seconds, 'peak_bytes': peak}
+
+                data, seconds, peak = measure(lambda: encode_image(source, dots), repeat, warm)
+                stages['encode'] = {'seconds': seconds, 'peak_bytes': peak}
+
+                payload, seconds, peak = measure(lambda: compress(data), repeat, warm)
+                stages['rasterize'] = {'seconds': seconds, 'peak_bytes': peak}
+
+                builder, seconds, peak = measure(
+                    lambda: build_label_job([(payload, True)], media_widths[dots]), repeat, warm)
+                stages['commands'] = {'seconds': seconds, 'peak_bytes': peak}
+
+                socket, seconds, peak = measure(lambda: send_to_fake_socket(builder.getvalue()), repeat, warm)
+                stages['send'] = {'seconds': seconds, 'peak_bytes': peak}
+
+                results.append({
+                    'dots': dots,
+                    'media_width': media_widths[dots],
+                    'content': kind,
+                    'length': payload.lines,
+                    'warm': warm,
+                    'stages': stages,
+                    'total_seconds': sum(stage['seconds'] for stage in stages.values()),
+                    'bytes_on_wire': len(socket.data),
+                    'writes': socket.writes,
+                })
+
+    return results
+
+
+def send_to_fake_socket(data):
+    socket = FakeSocket()
+    send_buffer(socket, data)
+    return socket
+
+
+def print_pipeline(results):
+    print(f"{'dots':>5} {'content':>8} {'length':>7} " + " ".join(f"{stage + ' (ms)':>14}" for stage in STAGES) +
+          f" {'peak (KiB)':>11} {'wire bytes':>11}")
+
+    for result in results:
+        stages = result['stages']
+        times = " ".join(f"{stages[stage]['seconds'] * 1000:>14.2f}" if stage in stages else f"{'-':>14}"
+                         for stage in STAGES)
+        peak = max(stage['peak_bytes'] for stage in stages.values())
+        print(f"{result['dots']:>5} {result['content']:>8} {result['length']:>7} {times} {peak / 1024:>11.1f} "
+              f"{result['bytes_on_wire']:>11}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the PT-P710BT label pipeline')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    encoder = subparsers.add_parser('encoder', help='Compare the vectorized PNG encoder with the original one')
+    encoder.add_argument('--lengths', type=int, nargs='+', default=LABEL_LENGTHS, help='Label lengths in pixels')
+    encoder.add_argument('--repeat', type=int, default=3, help='Number of timed runs per measurement')
+
+    rasterizer = subparsers.add_parser('rasterizer', help='Compare the single pass compressor with the original one')
+    rasterizer.add_argument('--lengths', type=int, nargs='+', default=LABEL_LENGTHS, help='Label lengths in pixels')
+    rasterizer.add_argument('--repeat', type=int, default=3, help='Number of timed runs per measurement')
+
+    conversion = subparsers.add_parser('conversion',
+                                       help='Compare the PNG alpha encoder with the image conversion methods')
+    conversion.add_argument('--lengths', type=int, nargs='+', default=LABEL_LENGTHS, help='Label lengths in pixels')
+    conversion.add_argument('--repeat', type=int, default=3, help='Number of timed runs per measurement')
+
+    streaming = subparsers.add_parser('streaming', help='Compare the streaming encoder with the whole image one')
+    streaming.add_argument('--lengths', type=int, nargs='+', default=LABEL_LENGTHS, help='Label lengths in pixels')
+
+    pipeline = subparsers.add_parser('pipeline', help='Time every stage from rendering to the bytes on the wire')
+    pipeline.add_argument('--lengths', type=int, nargs='+', default=LABEL_LENGTHS, help='Label lengths in pixels')
+    pipeline.add_argument('--content', type=str, nargs='+', choices=CONTENT_KINDS, default=CONTENT_KINDS,
+                          help='Kinds of label content')
+    pipeline.add_argument('--repeat', type=int, default=3, help='Number of timed runs per measurement')
+    pipeline.add_argument('--warm', action='store_true',
+                          help='Reuse the fonts, text lines and raster lines earlier runs cached, instead of starting '
+                               'every run with empty caches')
+    pipeline.add_argument('--json', type=str, metavar='PATH', help='Write the results as JSON, "-" for stdout')
+
+    options = parser.parse_args()
+
+    if options.benchmark == 'encoder':
+        bench_encoder(options.lengths, options.repeat)
+    elif options.benchmark == 'rasterizer':
+        bench_rasterizer(options.lengths, repeat=options.repeat)
+    elif options.benchmark == 'conversion':
+        bench_conversion(options.lengths, options.repeat)
+    elif options.benchmark == 'streaming':
+        bench_streaming(options.lengths)
+    elif options.benchmark == 'pipeline':
+        # Keep the progress output of the pipeline itself out of the results
+        with contextlib.redirect_stdout(sys.stderr):
+            results = bench_pipeline(options.lengths, options.content, options.repeat, options.warm)
+
+        if options.json == '-':
+            json.dump(results, sys.stdout, indent=2)
+        else:
+            print_pipeline(results)
+            if options.json:
+                with open(options.json, 'w') as fd:
+                    json.dump(results, fd, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -32,6 +32,7 @@ def set_default_bt(default_bt: str):
 def get_defaults() -> dict:
     config = {}
     config['default_bt'] = load_config().get('default_bt');
+    config['printers'] = load_config().get('printers');
     config['host'] = load_config().get('host');
     config['port'] = load_config().get('port');
     config['password'] = load_config().get('password');
@@ -39,9 +40,10 @@ def get_defaults() -> dict:
 
     return config
 
-def set_defaults(bt: str, host: str, port: int, password: str, username: str):
+def set_defaults(bt: list, host: str, port: int, password: str, username: str):
     config = load_config()
-    config['default_bt'] = bt;
+    config['default_bt'] = bt[0];
+    config['printers'] = bt;
     config['host'] = host;
     config['port'] = port;
     if password:
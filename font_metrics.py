@@ -0,0 +1,139 @@
+import argparse
+import functools
+import hashlib
+import json
+import os
+import threading
+
+import appdirs
+from PIL import ImageFont
+
+from label_rasterizer import TZE_DOTS
+
+# Part of the tape height the font's line height (ascent + descent) may take up. 0.54 gives the sizes FreeSans was
+# tuned to by hand: 10, 14, 22, 31, 50 and 57 points for 3.5 to 24mm tape
+DEFAULT_HEIGHT_RATIO = 0.54
+
+# Size the font is loaded at to measure it, metrics scale linearly from there
+REFERENCE_SIZE = 1000
+
+METRICS_DIR = os.path.join(appdirs.user_cache_dir(), 'pt-p710bt-font-metrics')
+
+
+class FontMetrics:
+    """
+    The font sizes that fit each tape height for one font file
+
+    The font is loaded once at REFERENCE_SIZE to measure its ascent and descent, the size for a height follows from
+    scaling those. The table is stored per font file, so it is only computed again when the font file changes.
+    """
+
+    def __init__(self, font_path, height_ratio=DEFAULT_HEIGHT_RATIO, directory=METRICS_DIR):
+        """
+        :param height_ratio: Part of the image height the line height of the font may take up
+        :param directory: Directory to store the tables in, None to not store them
+        """
+        self.font_path = font_path
+        self.height_ratio = height_ratio
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.ascent = None
+        self.descent = None
+        self.sizes = {}
+
+        if not self._load():
+            self._measure()
+            self._save()
+
+    def _stamp(self):
+        """Identifies the version of the font file and the settings the table was made with"""
+        stat = os.stat(self.font_path)
+        return {'path': os.path.abspath(self.font_path), 'mtime': stat.st_mtime, 'bytes': stat.st_size,
+                'height_ratio': self.height_ratio, 'reference_size': REFERENCE_SIZE}
+
+    def _path(self):
+        name = hashlib.sha256(os.path.abspath(self.font_path).encode()).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def _load(self):
+        if not self.directory:
+            return False
+
+        try:
+            with open(self._path(), 'r') as fd:
+                table = json.load(fd)
+        except (OSError, ValueError):
+            return False
+
+        if table.get('stamp') != self._stamp():
+            return False
+
+        self.ascent = table['ascent']
+        self.descent = table['descent']
+        self.sizes = {int(height): size for height, size in table['sizes'].items()}
+        return True
+
+    def _save(self):
+        if not self.directory:
+            return
+
+        table = {'stamp': self._stamp(), 'ascent': self.ascent, 'descent': self.descent,
+                 'sizes': {str(height): size for height, size in self.sizes.items()}}
+
+        # Write to a temporary file first, so another process never reads a partial table
+        path = self._path()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + '.tmp', 'w') as fd:
+                json.dump(table, fd)
+            os.replace(path + '.tmp', path)
+        except OSError as error:
+            # The table is only a cache, keep it in memory and don't try to store it again
+            print(f"Could not store the font metrics of {self.font_path} in {self.directory}: {error}")
+            self.directory = None
+
+    def _measure(self):
+        font = ImageFont.truetype(self.font_path, REFERENCE_SIZE)
+        self.ascent, self.descent = font.getmetrics()
+        self.sizes = {height: self._solve(height) for height in TZE_DOTS.values()}
+
+    def _solve(self, height):
+        line_height = (self.ascent + self.descent) / REFERENCE_SIZE
+        return max(1, int(self.height_ratio * height / line_height))
+
+    def font_size(self, height):
+        """The largest font size whose line height fits `height` dots"""
+        with self.lock:
+            if height not in self.sizes:
+                # Not a tape height, e.g. a part of a label
+                self.sizes[height] = self._solve(height)
+                self._save()
+            return self.sizes[height]
+
+
+@functools.lru_cache(maxsize=None)
+def get_font_metrics(font_path, height_ratio=DEFAULT_HEIGHT_RATIO):
+    return FontMetrics(font_path, height_ratio)
+
+
+def font_size(font_path, height, height_ratio=DEFAULT_HEIGHT_RATIO):
+    """The font size to render text `height` dots high with, see FontMetrics"""
+    return get_font_metrics(font_path, height_ratio).font_size(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the font size used for each tape width')
+    parser.add_argument('font', nargs='+', help='Paths to TrueType fonts')
+    parser.add_argument('--height-ratio', type=float, default=DEFAULT_HEIGHT_RATIO,
+                        help='Part of the tape height the line height of the font may take up')
+    options = parser.parse_args()
+
+    for font_path in options.font:
+        metrics = get_font_metrics(font_path, options.height_ratio)
+        print(f"{font_path} (ascent {metrics.ascent}, descent {metrics.descent} at {REFERENCE_SIZE} points)")
+        for media_width, dots in TZE_DOTS.items():
+            print(f"  {media_width}mm tape, {dots} dots: {metrics.font_size(dots)} points")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import io
+import os
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image
+
+# 'auto' prints by alpha channel when the image has transparent pixels, and by brightness threshold otherwise
+CONVERSION_METHODS = ('auto', 'alpha', 'threshold', 'ordered', 'floyd-steinberg')
+DEFAULT_THRESHOLD = 128
+
+
+class Conversion(NamedTuple):
+    """
+    How the pixels of an image are turned into the dots of the print head
+
+    `alpha` prints every pixel that is not fully transparent, `threshold` every pixel darker than `threshold` on
+    white tape. `ordered` and `floyd-steinberg` dither, so greyscale scans and photos print as patterns of dots. With
+    `fit`, images of another height are scaled to the height of the tape.
+    """
+    method: str = 'auto'
+    threshold: int = DEFAULT_THRESHOLD
+    fit: bool = False
+
+
+DEFAULT_CONVERSION = Conversion()
+
+
+def bayer_matrix(size):
+    """The order in which the dots of a size x size tile are inked as it gets darker, size a power of 2"""
+    matrix = np.zeros((1, 1), dtype=np.int32)
+    while len(matrix) < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+
+# Brightness below which each dot of an 8 x 8 tile is printed, spread evenly over 0-255
+ORDERED_THRESHOLDS = ((bayer_matrix(8) + 0.5) * 256 / 64).astype(np.uint8)
+
+
+def open_image(image):
+    """
+    A PIL image of anything Pillow reads
+
+    :param image: A PIL image, a path, image data as bytes or a file-like object, a 2D array of alpha values or an
+                  array of RGB or RGBA pixels
+    """
+    if isinstance(image, Image.Image):
+        return image
+    if isinstance(image, (str, os.PathLike)) or hasattr(image, 'read'):
+        return Image.open(image)
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return Image.open(io.BytesIO(image))
+
+    array = np.asarray(image)
+    if array.dtype == bool:
+        array = array * np.uint8(255)
+    array = array.astype(np.uint8, copy=False)
+    if array.ndim == 2:
+        # Black ink with these alpha values, like the alpha channel of a PNG
+        return Image.merge('LA', (Image.new('L', (array.shape[1], array.shape[0]), 0), Image.fromarray(array)))
+    return Image.fromarray(array)
+
+
+def has_alpha(image):
+    return 'A' in image.getbands() or 'transparency' in image.info
+
+
+def has_transparent_pixels(image):
+    """Whether any pixel of an image with an alpha band is not fully opaque"""
+    return image.getchannel('A').getextrema()[0] < 255
+
+
+def image_ink(image, target_height=None, conversion=DEFAULT_CONVERSION):
+    """
+    Convert an image to the dots to print
+
+    :param image: Anything `open_image` accepts
+    :param target_height: Height of the tape in dots, images are scaled to it with `conversion.fit`
+    :return: 2D boolean array, True for the pixels to print
+    """
+    image = open_image(image)
+    alpha = has_alpha(image)
+    if image.mode in ('I', 'F') or image.mode.startswith('I;16'):
+        image = scale_to_8_bits(image)
+    if image.mode not in ('L', 'LA', 'RGB', 'RGBA') or (alpha and 'A' not in image.getbands()):
+        # Palette and 1 bit images so scaling interpolates, and a transparent colour (tRNS) as an alpha band, so the
+        # channels are read the same way
+        image = image.convert(('LA' if image.mode in ('L', '1') else 'RGBA') if alpha else 'L')
+
+    if conversion.fit and target_height and image.height != target_height:
+        width = max(1, round(image.width * target_height / image.height))
+        image = image.resize((width, target_height), Image.LANCZOS)
+
+    method = conversion.method
+    if method == 'auto':
+        # Most editors save an alpha band even if every pixel is opaque, those images are printed by brightness
+        method = 'alpha' if alpha and has_transparent_pixels(image) else 'threshold'
+
+    if method == 'alpha':
+        if not alpha:
+            # Fully opaque, every pixel is printed
+            return np.ones((image.height, image.width), dtype=bool)
+        return np.asarray(image.getchannel('A')) > 0
+
+    brightness = luminance(image, alpha)
+    if method == 'threshold':
+        return brightness < conversion.threshold
+    if method == 'ordered':
+        height, width = brightness.shape
+        thresholds = np.tile(ORDERED_THRESHOLDS, (-(-height // 8), -(-width // 8)))
+        return brightness < thresholds[:height, :width]
+    if method == 'floyd-steinberg':
+        # Error diffusion depends on the pixels before it, so it can't be done as array operations. Pillow's C
+        # implementation runs it in one pass
+        return ~np.asarray(Image.fromarray(brightness).convert('1', dither=Image.Dither.FLOYDSTEINBERG))
+
+    raise ValueError(f"Unknown conversion {conversion.method}, use one of {', '.join(CONVERSION_METHODS)}")
+
+
+def scale_to_8_bits(image):
+    """
+    16 bit, 32 bit and floating point greyscale images as an 'L' image ('LA' with a transparent value), Pillow's
+    `convert` clips them to 0-255 instead of scaling them
+
+    Integers above 255 are taken as 16 bit values, e.g. PNGs that older Pillow versions read as 'I', floats of at
+    most 1 as 0.0-1.0.
+    """
+    if image.mode.startswith('I;16'):
+        scaled = Image.fromarray((np.asarray(image).astype(np.uint16) >> 8).astype(np.uint8))
+    else:
+        values = np.asarray(image, dtype=np.float64)
+        peak = values.max(initial=0)
+        if image.mode == 'F' and peak <= 1:
+            full_scale = 1
+        elif peak > 255:
+            full_scale = 65535
+        else:
+            full_scale = 255
+        scaled = Image.fromarray(np.clip(values * 255 / full_scale, 0, 255).round().astype(np.uint8))
+
+    transparency = image.info.get('transparency')
+    if transparency is None:
+        return scaled
+    # The transparent value is one of the original values, so the alpha band is made before scaling
+    opaque = (np.asarray(image) != transparency).astype(np.uint8) * np.uint8(255)
+    return Image.merge('LA', (scaled, Image.fromarray(opaque)))
+
+
+def luminance(image, alpha):
+    """Brightness of every pixel as a 2D array, transparent pixels show the white tape"""
+    if not alpha:
+        return np.asarray(image.convert('L'))
+
+    grey = np.asarray(image.convert('LA'), dtype=np.uint16)
+    darkness = (grey[:, :, 1] * (255 - grey[:, :, 0]) + 127) // 255
+    return (255 - darkness).astype(np.uint8)
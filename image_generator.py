@@ -1,69 +1,24 @@
-from PIL import Image, ImageDraw, ImageFont
+from label_cache import load_font
+from text_layout import layout_text, render_layout
 
-WIDTH_TO_FONT_SIZE = {
-    24: 10,  
-    32: 14,
-    50: 22,
-    70: 31,
-    112: 50,
-    128: 57
-}
+#FONT_PATH = "/Library/Fonts/LiberationSans-Regular.ttf"
+FONT_PATH = "/usr/share/fonts/truetype/freefont/FreeSans.ttf"
 
-#If you would use a different font or different label sizes, this can be used to calculate the appropriate font size.
-def calculate_font_size(text, font_path, image_height, desired_height_ratio):
-    def calculate_height(font_size):
-        font = ImageFont.truetype(font_path, font_size)
-        width, height = ImageDraw.Draw(Image.new("RGBA", (0, 0), (255, 255, 255, 0))).textsize(text, font=font)
-        return height
+def text_to_image(text, image_height, font_path=FONT_PATH, max_length=None, max_lines=None):
+    """
+    Render text as a label, see text_layout.parse_markup for the markup
 
-    low, high = 0, image_height
-    while low < high:
-        mid = (low + high) // 2
-        height = calculate_height(mid)
-        if height / image_height < desired_height_ratio:
-            low = mid + 1
-        else:
-            high = mid
+    :param max_length: Longest label in dots, longer texts are wrapped over more lines and shrunk to fit
+    :param max_lines: Most lines to wrap the text over, None for as many as stay readable
+    """
+    layout = layout_text(text, image_height, font_path, max_length, max_lines)
+    print(f"text_width: {layout.width}, {len(layout.lines)} lines at {layout.font_size} points")
 
-    return low
-
-def text_to_image(text, image_height):
-    #font_path = "/Library/Fonts/LiberationSans-Regular.ttf"
-    font_path = "/usr/share/fonts/truetype/freefont/FreeSans.ttf"
-
-    #for value in WIDTH_TO_FONT_SIZE.keys():
-    #    pointsize = calculate_font_size(text, font_path, image_height, 0.5)
-    #    print(f"value: {value}")
-    #    print(f"pointsize: {pointsize}")
-    
-    font_size = WIDTH_TO_FONT_SIZE[image_height]
-    text_width = calculate_text_size(text, font_path, font_size)
-    image_width = text_width + 10;
-    print(f"text_width: {text_width}")
-    image_size = (image_width, image_height)
-    
-    # Create a transparent image
-    image = Image.new("RGBA", image_size, (255, 255, 255, 0))
-    draw = ImageDraw.Draw(image)
-    
-    # Load the font and set the font size
-    font = ImageFont.truetype(font_path, font_size)
-    
-    # Draw the text on the image
-    draw.text(
-        xy=(image_width / 2, image_height / 2),
-        text=text,
-        fill=(0, 0, 0, 255),
-        font=font,
-        anchor="mm",
-        align="center"
-    )
-    
-    return image
+    return render_layout(layout)
 
 def calculate_text_size(text, font_path, font_size):
     # Load the font and set the font size
-    font = ImageFont.truetype(font_path, font_size)
+    font = load_font(font_path, font_size)
     # Get the size of the text
     return int(font.getlength(text))
 
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import ImageFont
+
+from label_rasterizer import RasterPayload
+
+DEFAULT_FONT_CACHE_SIZE = 16
+DEFAULT_PAYLOAD_CACHE_SIZE = 256
+
+
+class LRUCache:
+    """A thread-safe least recently used cache that counts its hits and misses"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """Forget the values in memory, e.g. to time the work they save"""
+        with self.lock:
+            self.entries.clear()
+
+    def __contains__(self, key):
+        """True if `key` is in memory, without loading it or counting a hit or miss"""
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        value = self.load(key)
+
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._store(key, value)
+
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._store(key, value)
+        self.save(key, value)
+
+    def get_or_create(self, key, create):
+        """Return the cached value for `key`, calling `create()` to make (and cache) it on a miss"""
+        value = self.get(key)
+        if value is None:
+            value = create()
+            self.put(key, value)
+        return value
+
+    def load(self, key):
+        """Hook for a second level store, called on a miss"""
+        return None
+
+    def save(self, key, value):
+        """Hook for a second level store, called when a value is added"""
+
+    def _store(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+class PayloadCache(LRUCache):
+    """
+    Cache of the compressed raster lines of rendered labels
+
+    With a directory, payloads are also written to disk, so they survive restarts and the in-memory cache can be
+    smaller than the set of labels that are printed. A file has the number of raster lines and of lines left out by
+    trimming, followed by the raster data.
+    """
+
+    def __init__(self, maxsize=DEFAULT_PAYLOAD_CACHE_SIZE, directory=None):
+        super().__init__(maxsize)
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode()).hexdigest() + '.raster')
+
+    def load(self, key):
+        if not self.directory:
+            return None
+
+        try:
+            with open(self._path(key), 'rb') as fd:
+                data = fd.read()
+        except OSError:
+            return None
+
+        return RasterPayload(int.from_bytes(data[:4], 'little'), data[8:],
+                             int.from_bytes(data[4:8], 'little', signed=True))
+
+    def save(self, key, value):
+        if not self.directory:
+            return
+
+        # Write to a temporary file first, so a concurrent reader never sees a partial payload
+        path = self._path(key)
+        with open(path + '.tmp', 'wb') as fd:
+            fd.write(value.lines.to_bytes(4, 'little'))
+            fd.write(value.trimmed.to_bytes(4, 'little', signed=True))
+            fd.write(value.raster)
+        os.replace(path + '.tmp', path)
+
+
+def payload_key(text, media_dots, font_path, font_size, max_length=None, max_lines=None):
+    return text, media_dots, font_path, font_size, max_length, max_lines
+
+
+font_cache = LRUCache(DEFAULT_FONT_CACHE_SIZE)
+
+
+def load_font(font_path, font_size):
+    """Load a TrueType font, reusing it if it was loaded before"""
+    return font_cache.get_or_create((font_path, font_size), lambda: ImageFont.truetype(font_path, font_size))
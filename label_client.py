@@ -0,0 +1,81 @@
+import argparse
+import base64
+import json
+import os
+import socket
+import sys
+
+# Only standard library modules that load quickly, printing a label through the daemon costs a Python startup and a
+# local round trip instead of the imports, bluetooth connection and status request of label_maker.py
+
+
+def default_socket_path():
+    """The daemon's socket, in the user's runtime directory"""
+    directory = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+    return os.path.join(directory, f"pt-p710bt-{os.getuid()}.sock")
+
+
+def request(message, socket_path=None, timeout=None):
+    """
+    Send a request to the daemon and wait for its reply
+
+    :param message: Dict with the request, see label_daemon.py
+    :param timeout: Seconds to wait for the reply, None to wait until the labels are printed
+    :return: The reply as a dict, with `ok` and either the results or an `error`
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(socket_path or default_socket_path())
+        connection.sendall(json.dumps(message).encode() + b'\n')
+        connection.shutdown(socket.SHUT_WR)
+
+        reply = b''
+        while True:
+            data = connection.recv(4096)
+            if not data:
+                break
+            reply += data
+    finally:
+        connection.close()
+
+    return json.loads(reply)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print labels through a running label_daemon.py')
+    parser.add_argument('--image', type=str, help='Path to an image to print, "-" to read the image from stdin')
+    parser.add_argument('--text', type=str, nargs='+', help='Texts to print, one label per text')
+    parser.add_argument('--spool', type=str, help='Path to a spool file to print')
+    parser.add_argument('--no-cut', action='store_true', help="Don't cut after the labels")
+    parser.add_argument('-i', '--info', action='store_true', help="Show the printer status the daemon knows")
+    parser.add_argument('--socket', type=str, default=default_socket_path(), help='Path of the daemon socket')
+    options = parser.parse_args()
+
+    if options.info:
+        message = {'info': True}
+    elif options.image == '-':
+        message = {'image_data': base64.b64encode(sys.stdin.buffer.read()).decode()}
+    elif options.image:
+        # The daemon may run in another directory
+        message = {'image': os.path.abspath(options.image)}
+    elif options.text:
+        message = {'text': options.text}
+    elif options.spool:
+        message = {'spool': os.path.abspath(options.spool)}
+    else:
+        parser.error('An image, text or spool file to print is required')
+    message['cut'] = not options.no_cut
+
+    try:
+        reply = request(message, options.socket)
+    except OSError as error:
+        sys.exit(f"Could not reach the label daemon on {options.socket}: {error}")
+
+    if not reply.get('ok'):
+        sys.exit(f"Error: {reply.get('error')}")
+    print(json.dumps({key: value for key, value in reply.items() if key != 'ok'}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+from enum import IntEnum, IntFlag
+
+from label_rasterizer import CHUNK_SIZE
+
+# The largest RFCOMM frame payload with BlueZ's default L2CAP MTU of 1013 bytes
+MAX_WRITE_SIZE = 1008
+
+# Upper bound of the commands around the raster data of a page
+MAX_PAGE_COMMANDS_SIZE = 64
+
+
+class Mode(IntFlag):
+    AUTO_CUT = 0x40
+    MIRROR_PRINTING = 0x80
+
+
+class AdvancedMode(IntFlag):
+    HALF_CUT = 0x04
+    NO_CHAIN_PRINTING = 0x08
+    SPECIAL_TAPE = 0x10
+    HIGH_RESOLUTION_PRINTING = 0x40
+    NO_BUFFER_CLEARING = 0x80
+
+
+class PageType(IntEnum):
+    STARTING_PAGE = 0x00
+    OTHER_PAGE = 0x01
+    LAST_PAGE = 0x02
+
+
+class CommandBuilder:
+    """
+    Build the byte stream of a print job in a single pre-sized buffer
+
+    Every command method appends to the buffer and returns the builder, so commands can be chained. The result can be
+    sent with `send_buffer`, or inspected directly to check the exact bytes a job produces.
+    """
+
+    def __init__(self, size_hint=0):
+        self.buffer = bytearray(size_hint)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, data):
+        end = self.length + len(data)
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(max(end - len(self.buffer), len(self.buffer))))
+
+        self.buffer[self.length:end] = data
+        self.length = end
+        return self
+
+    def getvalue(self) -> memoryview:
+        """The commands built so far, without the unused part of the buffer"""
+        return memoryview(self.buffer)[:self.length]
+
+    def invalidate(self):
+        """100 null bytes"""
+        return self.append(b"\x00" * 100)
+
+    def initialize(self):
+        """Initialization Code [1B 40]"""
+        return self.append(b"\x1B\x40")
+
+    def switch_dynamic_command_mode(self):
+        """set dynamic command mode to "raster mode" [1B 69 61 {01}]"""
+        return self.append(b"\x1B\x69\x61\x01")
+
+    def switch_automatic_status_notification_mode(self):
+        """set automatic status notification mode to "notify" [1B 69 21 {00}]"""
+        return self.append(b"\x1B\x69\x21\x00")
+
+    def print_information(self, data_length: int, width: int, page=PageType.STARTING_PAGE):
+        """
+        Print to tape
+
+        Command: [1B 69 7A {84 00 18 00 <data length 4 bytes> <page> 00}]
+
+        This is defined in the Brother Documentation under 'ESC i z Print information command'
+
+        :param data_length: The length of the data that will be sent
+        :param width: Width of the tape used in mm
+        :param page: Whether this is the starting, a following or the last page of the job
+        """
+        self.append(b"\x1B\x69\x7A\x84\x00")
+        self.append(bytes((width, 0)))  # n3 as per docs, n4
+        self.append((data_length >> 4).to_bytes(4, 'little'))
+        return self.append(bytes((page, 0)))  # n9, n10
+
+    def various_mode_settings(self, auto_cut=True):
+        """set to auto-cut (or no cut), no mirror printing [1B 69 4D {40}]"""
+        self.append(b"\x1B\x69\x4D")
+        return self.append((Mode.AUTO_CUT if auto_cut else Mode(0)).to_bytes(1, "big"))
+
+    def advanced_mode_settings(self, chain_printing=False):
+        """Set print chaining off [1B 69 4B {08}] or on [1B 69 4B {00}]"""
+        self.append(b"\x1B\x69\x4B")
+        return self.append((AdvancedMode(0) if chain_printing else AdvancedMode.NO_CHAIN_PRINTING).to_bytes(1, "big"))
+
+    def specify_margin_amount(self):
+        """Set margin (feed) amount to 0 [1B 69 64 {00 00}]"""
+        return self.append(b"\x1B\x69\x64\x00\x00")
+
+    def select_compression_mode(self):
+        """Set to TIFF compression [4D {02}]"""
+        return self.append(b"\x4D\x02")
+
+    def raster_data(self, payload):
+        """All raster data lines"""
+        return self.append(payload.raster)
+
+    def print_command_with_feeding(self):
+        """print and feed [1A]"""
+        return self.append(b"\x1A")
+
+    def print_command(self):
+        """print without feeding, separates the pages of a job [0C]"""
+        return self.append(b"\x0C")
+
+    def status_information_request(self):
+        """request status information [1B 69 53]"""
+        return self.append(b"\x1B\x69\x53")
+
+
+def job_size_hint(pages) -> int:
+    """Size of a job printing the pages"""
+    return sum(MAX_PAGE_COMMANDS_SIZE + len(payload.raster) for payload, _ in pages)
+
+
+def build_label_job(pages, media_width, chain_printing=False) -> CommandBuilder:
+    """
+    Build the commands to print several pages as one job
+
+    :param pages: List of (RasterPayload, cut) tuples, `cut` tells whether to cut after that page
+    :param media_width: Width of the tape used in mm
+    :param chain_printing: Don't feed and cut after the last page, so the next job continues on the same tape
+    """
+    builder = CommandBuilder(job_size_hint(pages))
+
+    for index, (payload, cut) in enumerate(pages):
+        build_page_start(builder, index, len(pages), payload.data_length, media_width, cut, chain_printing)
+        builder.raster_data(payload)
+        build_page_end(builder, index, len(pages))
+
+    return builder
+
+
+def build_page_start(builder, index, page_count, data_length, media_width, cut=True, chain_printing=False):
+    """
+    Add the commands that go before the raster data of a page
+
+    The first page also sets up the job, following pages only need their print information and cut mode.
+    """
+    if index == 0:
+        page = PageType.STARTING_PAGE
+        builder.switch_dynamic_command_mode()
+        builder.switch_automatic_status_notification_mode()
+    elif index == page_count - 1:
+        page = PageType.LAST_PAGE
+    else:
+        page = PageType.OTHER_PAGE
+
+    builder.print_information(data_length, media_width, page)
+    builder.various_mode_settings(cut)
+
+    if index == 0:
+        builder.advanced_mode_settings(chain_printing)
+        builder.specify_margin_amount()
+        builder.select_compression_mode()
+
+    return builder
+
+
+def build_page_end(builder, index, page_count):
+    """Add the command that prints a page, only the last page is fed out"""
+    if index == page_count - 1:
+        return builder.print_command_with_feeding()
+    return builder.print_command()
+
+
+def stream_label_job(socket, lines, raster_blocks, media_width, cut=True, chain_printing=False):
+    """
+    Send a single page job while its raster data is still being produced
+
+    :param lines: Number of raster lines of the page
+    :param raster_blocks: Iterable of compressed raster data, sent as soon as each block is produced
+    """
+    data_length = lines * CHUNK_SIZE
+    send_buffer(socket, build_page_start(CommandBuilder(), 0, 1, data_length, media_width, cut, chain_printing)
+                .getvalue())
+
+    for raster in raster_blocks:
+        send_buffer(socket, raster)
+
+    send_buffer(socket, build_page_end(CommandBuilder(), 0, 1).getvalue())
+
+
+def send_buffer(socket, data, write_size=MAX_WRITE_SIZE):
+    """Send a buffer in writes of at most `write_size` bytes"""
+    view = memoryview(data)
+    while view:
+        # PyBluez only accepts read-only buffers
+        sent = socket.send(bytes(view[:write_size]))
+        view = view[sent:]
@@ -0,0 +1,182 @@
+import argparse
+import base64
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+from types import SimpleNamespace
+
+import app_args
+from config import get_default_bt
+from image_generator import FONT_PATH, text_to_image
+from label_client import default_socket_path
+from label_maker import ConnectionState, PrinterError, bad_options, options_conversion, options_trim
+from label_rasterizer import DEFAULT_TRIM, trim_stats
+from label_spool import read_spool
+from printer_session import PrinterSession
+from text_layout import DOTS_PER_MM
+
+
+class LabelDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Keeps a PrinterSession open and prints the labels local clients ask for over a Unix domain socket
+
+    Every connection carries one request, a JSON object on one line, and gets one JSON reply when the labels are
+    printed::
+
+        {"image": "/path/to/label.png", "cut": true}
+        {"image_data": "<base64 encoded PNG, JPEG or other image>"}
+        {"text": ["Rack 1", "Rack 2"]}
+        {"spool": "/path/to/labels.spool"}
+        {"info": true}
+
+    Replies have `ok`, and either the printer's `state`, the `media_width` and the `seconds` the job took, or an
+    `error`. Jobs are printed one at a time, in the order the session lock is taken.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, session, font_path=FONT_PATH, max_length=None, max_lines=None, trim=DEFAULT_TRIM,
+                 conversion=None, stream_trim=None):
+        self.session = session
+        self.font_path = font_path
+        self.max_length = max_length
+        self.max_lines = max_lines
+        self.trim = trim
+        self.stream_trim = stream_trim
+        self.conversion = conversion
+        # Only the user running the daemon can print through it, the socket is created with these permissions so no
+        # one else can connect before they are set
+        umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, LabelRequestHandler)
+        finally:
+            os.umask(umask)
+
+    def handle_job(self, message):
+        if message.get('info'):
+            self.session.ensure_connected()
+            return {'bt_address': self.session.bt_address, 'media_width': self.session.media_width,
+                    **self.session.stats(), 'trim': trim_stats.stats()}
+
+        job = self.prepare(message)
+        start = time.monotonic()
+        try:
+            state = job()
+        except (OSError, PrinterError):
+            # The printer may be in the middle of a job, start over with a new connection. Bad requests, e.g. images
+            # that don't fit the tape, fail before anything is printed and keep the connection
+            self.session.close()
+            raise
+
+        if state == ConnectionState.DISCONNECTED:
+            raise ConnectionError(f"{self.session.bt_address} turned off before printing the label")
+        return {'state': state.name, 'media_width': self.session.media_width, 'seconds': time.monotonic() - start}
+
+    def prepare(self, message):
+        """Check and read what a request prints before the printer is involved, returns the function printing it"""
+        cut = bool(message.get('cut', True))
+
+        if 'image' in message:
+            if not os.path.isfile(message['image']):
+                raise ValueError(f"No image at {message['image']}")
+            # Streamed from the file, like label_maker.py --image
+            return lambda: self.session.print_label(SimpleNamespace(image=message['image']), self.stream_trim,
+                                                    self.conversion, cut)
+        if 'image_data' in message:
+            data = base64.b64decode(message['image_data'], validate=True)
+            return lambda: self.session.print_labels([(data, cut)], trim=self.trim, conversion=self.conversion)
+        if 'text' in message:
+            texts = message['text'] if isinstance(message['text'], list) else [message['text']]
+            return lambda: self._print_texts(texts, cut)
+        if 'spool' in message:
+            try:
+                spool = read_spool(message['spool'])
+            except OSError as error:
+                raise ValueError(f"Could not read spool file: {error}") from error
+            return lambda: self.session.print_spool(spool)
+        raise ValueError("The request has no image, image_data, text or spool")
+
+    def _print_texts(self, texts, cut):
+        # Rendered for the tape in the printer, which can't change while the session is locked
+        with self.session.lock:
+            self.session.ensure_connected()
+            height = self.session.media_height
+            return self.session.print_labels(
+                [(text_to_image(text, height, self.font_path, self.max_length, self.max_lines), cut) for text in texts],
+                trim=self.trim)
+
+
+class LabelRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline())
+            if not isinstance(message, dict):
+                raise ValueError("The request must be a JSON object")
+            reply = {'ok': True, **self.server.handle_job(message)}
+        except Exception as error:
+            print(f"Request failed: {error}")
+            reply = {'ok': False, 'error': str(error)}
+
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+def remove_stale_socket(socket_path):
+    """Remove the socket of a daemon that is gone, exit if one is still running"""
+    if not os.path.exists(socket_path):
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except OSError:
+        os.unlink(socket_path)
+    else:
+        bad_options(f"A label daemon is already running on {socket_path}")
+    finally:
+        probe.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep the printer connected and print what label_client.py sends')
+    parser.add_argument('bt_address', nargs='?', help='Bluetooth address of device (eg. "EC:79:49:63:2A:80"), '
+                                                      'or "tcp:HOST:PORT" for the printer simulator')
+    parser.add_argument('--bt-channel', type=int, default=1, help='Bluetooth Channel to use')
+    parser.add_argument('--socket', type=str, default=default_socket_path(), help='Path of the socket to listen on')
+    app_args.add_rendering_args(parser)
+    options = parser.parse_args()
+
+    bt_address = options.bt_address or get_default_bt()
+    if not bt_address:
+        bad_options("BT Address is required. If you'd like to remember it use label_maker.py --set-default")
+
+    # One attempt per request, so a printer that is off gives the client an error instead of a hang
+    session = PrinterSession(bt_address, options.bt_channel, connect_attempts=1)
+    try:
+        session.ensure_connected()
+    except (OSError, PrinterError) as error:
+        print(f"Could not connect to {bt_address} yet: {error}")
+
+    remove_stale_socket(options.socket)
+    max_length = round(options.max_length * DOTS_PER_MM) if options.max_length else None
+    server = LabelDaemon(options.socket, session, options.font, max_length, options.max_lines, options_trim(options),
+                         options_conversion(options), options_trim(options, streaming=True))
+    # serve_forever runs in the main thread, shut it down from another one
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"Listening on {options.socket}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(options.socket)
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
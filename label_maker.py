@@ -1,13 +1,22 @@
 import contextlib
 import sys
 from enum import IntEnum, IntFlag
+from typing import NamedTuple
 
-import bluetooth
+import socket as sockets
 import time
 
+try:
+    import bluetooth
+except ImportError:
+    # Only needed for real printers, the printer simulator is reached over TCP
+    bluetooth = None
+
 import app_args
 from config import set_default_bt, get_default_bt
-from label_rasterizer import encode_png, rasterize
+from label_commands import CommandBuilder, Mode, build_label_job, send_buffer, stream_label_job
+from image_conversion import Conversion
+from label_rasterizer import DEFAULT_TRIM, TZE_DOTS, Trim, compress, encode_image, stream_image, trim_stats
 
 from enum import Enum
 
@@ -25,18 +34,8 @@ STATUS_OFFSET_TAPE_COLOR_INFORMATION = 24
 STATUS_OFFSET_TEXT_COLOR_INFORMATION = 25
 STATUS_OFFSET_HARDWARE_SETTINGS = 26
 
-# Map the size of tape to the number of dots on the print area
-TZE_DOTS = {
-    3: 24,  # Actually 3.5mm, not sure how this is reported if its 3 or 4
-    6: 32,
-    9: 50,
-    12: 70,
-    18: 112,
-    24: 128
-}
-
-# Global for the media width so we can make sure we rasterize/ print to the right size
-detected_media_width = -1
+# Printer addresses starting with this are reached over TCP, e.g. "tcp:localhost:9100"
+TCP_ADDRESS_PREFIX = "tcp:"
 
 
 class ErrorInformation1(IntFlag):
@@ -60,11 +59,6 @@ class MediaType(IntEnum):
     INCOMPATIBLE_TAPE = 0xFF
 
 
-class Mode(IntFlag):
-    AUTO_CUT = 0x40
-    MIRROR_PRINTING = 0x80
-
-
 class StatusType(IntEnum):
     REPLY_TO_STATUS_REQUEST = 0x00
     PRINTING_COMPLETED = 0x01
@@ -146,148 +140,235 @@ class ConnectionState(Enum):
     DISCONNECTED = 3
 
 @contextlib.contextmanager
-def bt_socket_manager():
-    socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+def bt_socket_manager(bt_address=None):
+    socket = create_socket(bt_address)
 
     yield socket
 
     socket.close()
 
-def connect_bluetooth(socket, bt_address, bt_channel):
+def create_socket(bt_address=None):
+    """
+    Create the socket for a printer address
+
+    Addresses like "tcp:localhost:9100" get a TCP socket, e.g. to talk to `printer_simulator.py`, all others an RFCOMM
+    bluetooth socket.
+    """
+    if bt_address and bt_address.startswith(TCP_ADDRESS_PREFIX):
+        return sockets.socket(sockets.AF_INET, sockets.SOCK_STREAM)
+
+    if bluetooth is None:
+        raise ImportError("The bluetooth module (PyBluez) is required to connect to a printer")
+
+    return bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+
+def socket_address(bt_address, bt_channel=1):
+    """The address to connect a printer's socket to, (host, port) for "tcp:HOST:PORT" addresses"""
+    if bt_address.startswith(TCP_ADDRESS_PREFIX):
+        host, port = bt_address[len(TCP_ADDRESS_PREFIX):].rsplit(":", 1)
+        return host, int(port)
+    return bt_address, bt_channel
+
+def connect_bluetooth(socket, bt_address, bt_channel, attempts=None):
+    """
+    Connect the socket, retrying every 5 seconds
+
+    :param attempts: Number of attempts before the connection error is raised, None to keep trying
+    """
+    address = socket_address(bt_address, bt_channel)
+
+    attempt = 0
     while(True):    
+        attempt += 1
         try:
-            socket.connect((bt_address, bt_channel))
+            socket.connect(address)
             break;
-        except bluetooth.btcommon.BluetoothError as error:
+        except OSError as error:
+            if attempts is not None and attempt >= attempts:
+                raise
             print("Could not connect: ", error, "; Retrying in 5s...")
             time.sleep(5)
     return socket;
 
-def get_printer_info(socket):
-    send_invalidate(socket)
-    send_initialize(socket)
-    send_status_information_request(socket)
-
-    status_information = receive_status_information_response(socket)
-    handle_status_information(status_information)
-
-def get_media_height():
-    return TZE_DOTS.get(detected_media_width)
+def get_printer_info(socket, printer_state=None):
+    """
+    Request, print and return the printer status as StatusInformation
 
-def make_label(options, socket):
-    width = get_media_height()
-    data = encode_png(options.image, width)
+    Packets the printer sent on its own before the reply, e.g. the phase change after the previous label on a
+    connection that is kept open, are handled and applied to `printer_state` as well.
 
-    send_switch_dynamic_command_mode(socket)
-    send_switch_automatic_status_notification_mode(socket)
-    send_print_information_command(socket, len(data), detected_media_width)
-    send_various_mode_settings(socket)
-    send_advanced_mode_settings(socket)
-    send_specify_margin_amount(socket)
-    send_select_compression_mode(socket)
-    send_raster_data(socket, data)
-    send_print_command_with_feeding(socket)
+    :param printer_state: PrinterState to update with the reply
+    """
+    send_buffer(socket, CommandBuilder().invalidate().initialize().status_information_request().getvalue())
 
     while True:
         status_information = receive_status_information_response(socket)
-        state = handle_status_information(status_information)
-        if state == ConnectionState.DONE:
-            socket.close()
-            break;
-        if state == ConnectionState.DISCONNECTED:
-            socket.close()
-            break;
-
+        status = parse_status_information(status_information)
+        if printer_state is not None:
+            printer_state.update(status)
+        if handle_status_information(status_information) == ConnectionState.DISCONNECTED:
+            raise ConnectionError("The printer turned off before replying to the status request")
+        if status.status_type == StatusType.REPLY_TO_STATUS_REQUEST:
+            return status
+
+def make_label(options, socket, media_width, printer_state=None, trim=None, conversion=None, cut=True):
+    """
+    Print the image in `options.image`, for PNGs sending the raster data while the rest is still being encoded
 
-def send_invalidate(socket: bluetooth.BluetoothSocket):
-    """send 100 null bytes"""
-    socket.send(b"\x00" * 100)
+    :param media_width: Width of the tape in mm, as reported by the printer
+    :param printer_state: PrinterState to update with the status packets sent while printing
+    :param trim: How to trim the blank columns at both ends of the label, None to print every column
+    :param conversion: How the pixels are turned into dots, see image_conversion.Conversion
+    :param cut: Whether to cut after the label
+    """
+    lines, trimmed, raster_blocks = stream_image(options.image, TZE_DOTS.get(media_width), trim, conversion)
+    stream_label_job(socket, lines, raster_blocks, media_width, cut)
+    trim_stats.record(lines, trimmed)
 
+    return wait_for_completion(socket, printer_state=printer_state)
 
-def send_initialize(socket: bluetooth.BluetoothSocket):
-    """Send Initialization Code [1B 40]"""
-    socket.send(b"\x1B\x40")
 
+def make_labels(labels, socket, media_width, chain_printing=False, printer_state=None, trim=DEFAULT_TRIM,
+                conversion=None):
+    """
+    Print several labels as one job
 
-def send_switch_dynamic_command_mode(socket: bluetooth.BluetoothSocket):
-    """set dynamic command mode to "raster mode" [1B 69 61 {01}]"""
-    socket.send(b"\x1B\x69\x61\x01")
+    All labels are sent as pages of a single job, separated by print commands without feeding, so there is one setup
+    sequence and one wait for the printer to finish.
 
+    :param labels: List of (image, cut) tuples, `cut` tells whether to cut after that label. The image can be anything
+                   `encode_image` accepts, e.g. a path or a PIL image
+    :param socket: The bluetooth socket to use
+    :param media_width: Width of the tape in mm, as reported by the printer
+    :param chain_printing: Don't feed and cut after the last label, so the next job continues on the same tape
+    :param printer_state: PrinterState to update with the status packets sent while printing
+    :param trim: How to trim the blank columns at both ends of the labels, None to print every column
+    :param conversion: How the pixels are turned into dots, see image_conversion.Conversion
+    :return: The ConnectionState the printer ended in
+    """
+    height = TZE_DOTS.get(media_width)
+    pages = [(compress(encode_image(image, height, conversion), trim), cut) for image, cut in labels]
 
-def send_switch_automatic_status_notification_mode(socket: bluetooth.BluetoothSocket):
-    """set automatic status notification mode to "notify" [1B 69 21 {00}]"""
-    socket.send(b"\x1B\x69\x21\x00")
+    return print_pages(pages, socket, media_width, chain_printing, printer_state)
 
 
-def send_print_information_command(socket: bluetooth.BluetoothSocket, data_length: int, width):
+def print_pages(pages, socket, media_width, chain_printing=False, printer_state=None):
     """
-    Print to tape
-
-    Command: [1B 69 7A {84 00 18 00 <data length 4 bytes> 00 00}]
-
-    This is defined in the Brother Documentation under 'ESC i z Print information command'
+    Print already compressed pages as one job
 
+    :param pages: List of (RasterPayload, cut) tuples, `cut` tells whether to cut after that page
     :param socket: The bluetooth socket to use
-    :param data_length: The length of the data that will be sent
-    :param width: Width of the tape used in mm. Defaults to 24mm
+    :param media_width: Width of the tape in mm, as reported by the printer
+    :param chain_printing: Don't feed and cut after the last page, so the next job continues on the same tape
+    :param printer_state: PrinterState to update with the status packets sent while printing
+    :return: The ConnectionState the printer ended in
     """
-    socket.send(b"\x1B\x69\x7A\x84\x00")
-    socket.send(chr(width))  # n3 as per docs
-    socket.send(b"\x00")  # n4
-    socket.send((data_length >> 4).to_bytes(4, 'little'))
-    socket.send(b"\x00\x00")
-
-
-def send_various_mode_settings(socket: bluetooth.BluetoothSocket):
-    """set to auto-cut, no mirror printing [1B 69 4D {40}]"""
-    socket.send(b"\x1B\x69\x4D")
-    socket.send(Mode.AUTO_CUT.to_bytes(1, "big"))
-
+    send_buffer(socket, build_label_job(pages, media_width, chain_printing).getvalue())
+    trim_stats.record_pages(pages)
 
-def send_advanced_mode_settings(socket: bluetooth.BluetoothSocket):
-    """Set print chaining off [1B 69 4B {08}]"""
-    socket.send(b"\x1B\x69\x4B\x08")
+    return wait_for_completion(socket, len(pages), printer_state)
 
 
-def send_specify_margin_amount(socket: bluetooth.BluetoothSocket):
-    """Set margin (feed) amount to 0 [1B 69 64 {00 00}]"""
-    socket.send(b"\x1B\x69\x64\x00\x00")
+def wait_for_completion(socket, pages=1, printer_state=None):
+    """
+    Handle status information until the printer reports all pages are done or the printer turned off
 
+    The socket is left open, so it can be reused for the next label.
 
-def send_select_compression_mode(socket: bluetooth.BluetoothSocket):
-    """Set to TIFF compression [4D {02}]"""
-    socket.send(b"\x4D\x02")
+    :param pages: Number of pages the printer will report as completed
+    :param printer_state: PrinterState to update with every status packet, before errors are handled
+    :return: ConnectionState.DONE or ConnectionState.DISCONNECTED
+    """
+    completed = 0
+    while True:
+        status_information = receive_status_information_response(socket)
+        if printer_state is not None:
+            printer_state.update(parse_status_information(status_information))
+        state = handle_status_information(status_information)
+        if state == ConnectionState.DONE:
+            completed += 1
+            if completed == pages:
+                return state
+        if state == ConnectionState.DISCONNECTED:
+            return state
 
 
-def send_raster_data(socket: bluetooth.BluetoothSocket, data):
-    """Send all raster data lines"""
-    for line in rasterize(data):
-        socket.send(bytes(line))
+def send_invalidate(socket):
+    """send 100 null bytes"""
+    send_buffer(socket, CommandBuilder().invalidate().getvalue())
 
 
-def send_print_command_with_feeding(socket: bluetooth.BluetoothSocket):
-    """print and feed [1A]"""
-    socket.send(b"\x1A")
+def send_initialize(socket):
+    """Send Initialization Code [1B 40]"""
+    send_buffer(socket, CommandBuilder().initialize().getvalue())
 
 
-def send_status_information_request(socket: bluetooth.BluetoothSocket):
+def send_status_information_request(socket):
     """request status information [1B 69 53]"""
-    socket.send(b"\x1B\x69\x53")
+    send_buffer(socket, CommandBuilder().status_information_request().getvalue())
 
 
-def receive_status_information_response(socket: bluetooth.BluetoothSocket):
-    """receive status information"""
-    response = socket.recv(32)
-
-    if len(response) != 32:
-        sys.exit("Expected 32 bytes, but only received %d" % len(response))
+def receive_status_information_response(socket):
+    """receive status information, a stream socket (e.g. TCP) may hand over the 32 bytes in several parts"""
+    response = b''
+    while len(response) < 32:
+        data = socket.recv(32 - len(response))
+        if not data:
+            raise ConnectionError("Expected 32 bytes, but only received %d" % len(response))
+        response += data
 
     return response
 
 
+class StatusInformation(NamedTuple):
+    """The fields of a 32 byte status packet, without printing or acting on them"""
+    status_type: StatusType
+    error_information_1: ErrorInformation1
+    error_information_2: ErrorInformation2
+    media_width: int
+    media_type: int
+    mode: Mode
+    phase_type: int
+    phase_number: int
+    notification_number: int
+    tape_color: int
+    text_color: int
+
+
+def parse_status_information(status_information) -> StatusInformation:
+    return StatusInformation(
+        status_type=StatusType(status_information[STATUS_OFFSET_STATUS_TYPE]),
+        error_information_1=ErrorInformation1(status_information[STATUS_OFFSET_ERROR_INFORMATION_1]),
+        error_information_2=ErrorInformation2(status_information[STATUS_OFFSET_ERROR_INFORMATION_2]),
+        media_width=status_information[STATUS_OFFSET_MEDIA_WIDTH],
+        media_type=status_information[STATUS_OFFSET_MEDIA_TYPE],
+        mode=Mode(status_information[STATUS_OFFSET_MODE]),
+        phase_type=status_information[STATUS_OFFSET_PHASE_TYPE],
+        phase_number=int.from_bytes(status_information[STATUS_OFFSET_PHASE_NUMBER:STATUS_OFFSET_PHASE_NUMBER + 2],
+                                    "big"),
+        notification_number=status_information[STATUS_OFFSET_NOTIFICATION_NUMBER],
+        tape_color=status_information[STATUS_OFFSET_TAPE_COLOR_INFORMATION],
+        text_color=status_information[STATUS_OFFSET_TEXT_COLOR_INFORMATION],
+    )
+
+
+def status_errors(status: StatusInformation):
+    """The names of the error flags of a status packet, e.g. "NO_MEDIA, COVER_OPEN" """
+    errors = [f.name for f in type(status.error_information_1) if f in status.error_information_1]
+    errors += [f.name for f in type(status.error_information_2) if f in status.error_information_2]
+    return ', '.join(errors) or 'unknown'
+
+
+class PrinterError(Exception):
+    """The printer reported an error"""
+
+    def __init__(self, status: StatusInformation):
+        self.status = status
+        super().__init__(f"Printer error: {status_errors(status)}")
+
+
 def handle_status_information(status_information):
     def handle_reply_to_status_request(status_information):
-        global detected_media_width
         print("Printer Status")
         print("--------------")
         print("Media Width: %dmm" % status_information[STATUS_OFFSET_MEDIA_WIDTH])
@@ -296,8 +377,6 @@ def handle_status_information(status_information):
         print("Text Color: %s" % TextColor(status_information[STATUS_OFFSET_TEXT_COLOR_INFORMATION]).name)
         print()
 
-        detected_media_width = status_information[STATUS_OFFSET_MEDIA_WIDTH]
-
     def handle_printing_completed(status_information):
         print("Printing Completed")
         print("------------------")
@@ -318,7 +397,7 @@ def handle_status_information(status_information):
         print("Error information 1: %s" % ", ".join([f.name for f in ErrorInformation1 if f in error_information_1]))
         print("Error information 2: %s" % ", ".join([f.name for f in ErrorInformation2 if f in error_information_2]))
 
-        sys.exit("An error has occurred; exiting program")
+        raise PrinterError(parse_status_information(status_information))
 
     def handle_turned_off(status_information):
         print("Turned Off")
@@ -364,10 +443,73 @@ def bad_options(message):
     exit(1)
 
 
+def make_batch(options, socket, media_width):
+    """Print the images and texts given on the command line as one job"""
+    return make_labels(batch_labels(options, media_width), socket, media_width, trim=options_trim(options),
+                       conversion=options_conversion(options))
+
+
+def options_trim(options, streaming=False):
+    """
+    The Trim of the --no-trim, --trim-margin and --min-length options
+
+    :param streaming: For images that are streamed, which are only trimmed when --trim-margin or --min-length is
+                      given. Trimming reads the whole image before the first line can be sent
+    """
+    from text_layout import DOTS_PER_MM
+
+    if options.no_trim or (streaming and options.trim_margin is None and options.min_length is None):
+        return None
+    margin = DEFAULT_TRIM.margin if options.trim_margin is None else round(options.trim_margin * DOTS_PER_MM)
+    return Trim(margin, round((options.min_length or 0) * DOTS_PER_MM))
+
+
+def options_conversion(options):
+    """The Conversion of the --conversion, --threshold and --fit options"""
+    return Conversion(options.conversion, options.threshold, options.fit)
+
+
+def batch_labels(options, media_width):
+    """The (image, cut) tuples of the images and texts given on the command line"""
+    from image_generator import text_to_image
+
+    from text_layout import DOTS_PER_MM
+
+    max_length = round(options.max_length * DOTS_PER_MM) if options.max_length else None
+    images = list(options.batch or [])
+    images += [text_to_image(text, TZE_DOTS.get(media_width), options.font, max_length, options.max_lines)
+               for text in options.text or []]
+
+    return [(image, label_cut(options, number)) for number, image in enumerate(images, start=1)]
+
+
+def label_cut(options, number=1):
+    """Whether to cut after label `number` (starting at 1) of the job, according to --no-cut"""
+    # --no-cut without numbers means none of the labels are cut
+    no_cut = options.no_cut
+    return no_cut is None or (bool(no_cut) and number not in no_cut)
+
+
+def make_template_label(options, socket, media_width):
+    """Print the template in `options.template` with the `options.field` values filled in"""
+    return print_pages([(template_payload(options, media_width), label_cut(options))], socket, media_width)
+
+
+def template_payload(options, media_width):
+    """The RasterPayload of the template in `options.template` with the `options.field` values filled in"""
+    from label_templates import LabelTemplate
+
+    try:
+        values = dict(field.split('=', 1) for field in options.field or [])
+        return LabelTemplate.load(options.template).render(values, TZE_DOTS.get(media_width))
+    except (ValueError, OSError) as error:
+        bad_options(f"Could not render template {options.template}: {error}")
+
+
 def main():
     options = app_args.parse()
 
-    if not options.info and not options.image:
+    if not options.info and not options.image and not options.batch and not options.text and not options.template:
         bad_options('Image path required')
 
     if options.set_default:
@@ -384,14 +526,25 @@ def main():
         options.bt_address = default_bt
         print(f"Using BT Address of {options.bt_address}")
 
-    if options.info:
-        socket = connect_bluetooth(options.bt_address, options.bt_channel)
-        get_printer_info(socket)
-        exit(0)
-
-    socket = connect_bluetooth(options.bt_address, options.bt_channel)
-    get_printer_info(socket)
-    make_label(options, socket)
+    try:
+        with bt_socket_manager(options.bt_address) as socket:
+            connect_bluetooth(socket, options.bt_address, options.bt_channel)
+            media_width = get_printer_info(socket).media_width
+
+            if options.info:
+                exit(0)
+
+            if options.template:
+                make_template_label(options, socket, media_width)
+            elif options.batch or options.text:
+                make_batch(options, socket, media_width)
+            else:
+                make_label(options, socket, media_width, trim=options_trim(options, streaming=True),
+                           conversion=options_conversion(options), cut=label_cut(options))
+
+            trim_stats.report()
+    except (PrinterError, ConnectionError, ValueError, ImportError) as error:
+        sys.exit(str(error))
 
 if __name__ == "__main__":
     main()
@@ -1,28 +1,251 @@
-import sys
+import functools
+import re
+import threading
+import zlib
+from typing import NamedTuple
+
+import numpy as np
 import png
 import packbits
 
-CHUNK_SIZE = 16
-ZERO_CHUNK = bytearray(b"\x00" * CHUNK_SIZE)
+from image_conversion import DEFAULT_CONVERSION, Conversion, image_ink
+
+# Map the size of tape to the number of dots on the print area
+TZE_DOTS = {
+    3: 24,  # Actually 3.5mm, not sure how this is reported if its 3 or 4
+    6: 32,
+    9: 50,
+    12: 70,
+    18: 112,
+    24: 128
+}
+
+PRINT_HEAD_DOTS = 128
+CHUNK_SIZE = PRINT_HEAD_DOTS // 8
+ZERO_CHUNK = bytes(CHUNK_SIZE)
 RASTER_COMMAND = b"\x47"
 ZERO_COMMAND = b"\x5A"
 
+# Number of image columns stream_png encodes at once
+STREAM_BLOCK_COLUMNS = 1024
+
+# Most bytes of image data pypng gets from the decompressor at once
+DECOMPRESS_BLOCK_SIZE = 64 * 1024
+
+# Longest literal or run a single PackBits header can describe
+MAX_PACKBITS_LENGTH = 127
+EQUAL_BYTES_RUN = re.compile(rb"(.)\1*", re.DOTALL)
+
+DOTS_PER_INCH = 180
+
+# Blank lines kept before and after the ink when trimming, about 0.5mm. Less than the padding text_layout renders
+# around texts, so texts are trimmed as well
+DEFAULT_TRIM_MARGIN = 4
+
+
+class Trim(NamedTuple):
+    """
+    How the blank lines (image columns) at both ends of a label are trimmed
+
+    Blank lines beyond `margin` dots from the ink are neither sent nor printed. A label shorter than `min_length` dots
+    after trimming gets blank lines added back, split over both ends.
+    """
+    margin: int = DEFAULT_TRIM_MARGIN
+    min_length: int = 0
+
+
+DEFAULT_TRIM = Trim()
+
+
+class TrimStats:
+    """Raster lines of the labels sent by this process, and the blank lines trimming left out"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.labels = 0
+        self.trimmed_labels = 0
+        self.lines = 0
+        self.saved = 0
+
+    def record(self, lines, trimmed):
+        """
+        :param lines: Number of raster lines of a label that is sent
+        :param trimmed: Number of lines trimming left out, negative if lines were added to reach the minimum length
+        """
+        self.add(1, int(trimmed > 0), lines, trimmed)
+
+    def record_pages(self, pages):
+        """:param pages: List of (RasterPayload, cut) tuples of a job that is sent"""
+        for payload, _ in pages:
+            self.record(payload.lines, payload.trimmed)
+
+    def add(self, labels, trimmed_labels, lines, saved):
+        """Add the totals of labels that are sent, e.g. the pages of a spool file"""
+        with self.lock:
+            self.labels += labels
+            self.trimmed_labels += trimmed_labels
+            self.lines += lines
+            self.saved += saved
+
+    def stats(self):
+        with self.lock:
+            return {
+                'labels': self.labels,
+                'trimmed_labels': self.trimmed_labels,
+                'lines_sent': self.lines,
+                'lines_saved': self.saved,
+                'mm_saved': round(self.saved * 25.4 / DOTS_PER_INCH, 1),
+            }
+
+    def report(self):
+        stats = self.stats()
+        print(f"Trimmed {stats['lines_saved']} blank columns ({stats['mm_saved']}mm of tape) from "
+              f"{stats['trimmed_labels']} of {stats['labels']} labels")
+
+
+trim_stats = TrimStats()
+
+
+class RasterPayload(NamedTuple):
+    """Compressed raster lines of a label, ready to be sent after the print information command"""
+    lines: int
+    raster: bytes
+    # Blank lines left out by trimming, negative if lines were added to reach the minimum length
+    trimmed: int = 0
+
+    @property
+    def data_length(self):
+        """Length of the encoded image data the raster lines were compressed from"""
+        return self.lines * CHUNK_SIZE
+
+
+def compress(encoded_image_data, trim: Trim = None) -> RasterPayload:
+    """
+    Compress encoded image data into the raster lines to send to the printer
+
+    Runs of blank lines are found for the whole image at once and written as a block of zero raster commands. Every
+    other line is compressed only once, identical lines are looked up in `compress_line`'s cache.
+
+    :param trim: How to trim the blank lines at both ends, None to send every line
+    """
+    data = bytes(encoded_image_data)
+    lines = len(data) // CHUNK_SIZE
+    buffer = bytearray()
+
+    rows = np.frombuffer(data, dtype=np.uint8, count=lines * CHUNK_SIZE).reshape(lines, CHUNK_SIZE)
+    trimmed = 0
+    if trim is not None and not len(data) % CHUNK_SIZE:
+        start, end, before, after = trim_range(rows.any(axis=1), trim)
+        rows = np.pad(rows[start:end], ((before, after), (0, 0)))
+        data = rows.tobytes()
+        trimmed = lines - len(rows)
+        lines = len(rows)
+    blank = ~rows.any(axis=1)
+
+    # Split the lines into alternating runs of blank and inked lines
+    boundaries = np.flatnonzero(np.diff(blank)) + 1
+    starts = [0, *boundaries.tolist()]
+    ends = [*boundaries.tolist(), lines]
+
+    for start, end in zip(starts, ends) if lines else ():
+        if blank[start]:
+            buffer += ZERO_COMMAND * (end - start)
+        else:
+            for i in range(start * CHUNK_SIZE, end * CHUNK_SIZE, CHUNK_SIZE):
+                buffer += compress_line(data[i:i + CHUNK_SIZE])
+
+    # A partial line at the end is sent as is, like rasterize does
+    if len(data) % CHUNK_SIZE:
+        buffer += compress_line(data[lines * CHUNK_SIZE:])
+
+    return RasterPayload(lines, bytes(buffer), trimmed)
+
+
+def trim_range(inked, trim: Trim):
+    """
+    The lines to keep of a label
+
+    :param inked: Boolean array, True for the lines with ink
+    :return: (start, end, before, after), keep lines start to end and add `before` and `after` blank lines around them
+    """
+    indices = np.flatnonzero(inked)
+    if not len(indices):
+        # Nothing to print, leave blank labels as they are
+        return 0, len(inked), 0, 0
+
+    start = max(0, int(indices[0]) - trim.margin)
+    end = min(len(inked), int(indices[-1]) + 1 + trim.margin)
+    missing = max(0, trim.min_length - (end - start))
+    return start, end, missing // 2, missing - missing // 2
+
 
 def rasterize(encoded_image_data):
     for i in range(0, len(encoded_image_data), CHUNK_SIZE):
-        buffer = bytearray()
-        chunk = encoded_image_data[i:i + CHUNK_SIZE]
+        yield compress_line(bytes(encoded_image_data[i:i + CHUNK_SIZE]))
 
-        if chunk == ZERO_CHUNK:
-            buffer += ZERO_COMMAND
-        else:
-            packed_chunk = packbits.encode(chunk)
 
-            buffer += RASTER_COMMAND
-            buffer += len(packed_chunk).to_bytes(2, "little")
-            buffer += packbits.encode(chunk)
+@functools.lru_cache(maxsize=4096)
+def compress_line(chunk: bytes) -> bytes:
+    """The raster command for one line of encoded image data"""
+    if chunk == ZERO_CHUNK:
+        return ZERO_COMMAND
+
+    packed_chunk = packbits_encode(chunk)
+    return RASTER_COMMAND + len(packed_chunk).to_bytes(2, "little") + packed_chunk
+
+
+def packbits_encode(data: bytes) -> bytes:
+    """
+    Encode data using PackBits encoding, with the same output as `packbits.encode`
+
+    Runs of equal bytes are found with a regular expression, so only the runs are handled in Python instead of every
+    byte.
+    """
+    if len(data) > MAX_PACKBITS_LENGTH:
+        # Longer data needs runs and literals split up, which never happens for raster lines
+        return packbits.encode(data)
+
+    result = bytearray()
+    literal_start = None
 
-        yield buffer
+    for run in EQUAL_BYTES_RUN.finditer(data):
+        start, end = run.span()
+        if end - start == 1:
+            if literal_start is None:
+                literal_start = start
+            continue
+
+        if literal_start is not None:
+            result.append(start - literal_start - 1)
+            result += data[literal_start:start]
+            literal_start = None
+
+        result.append(257 - (end - start))
+        result.append(data[start])
+
+    if literal_start is not None:
+        result.append(len(data) - literal_start - 1)
+        result += data[literal_start:]
+
+    return bytes(result)
+
+
+def decompress_blocks(data_blocks):
+    """
+    Decompress the IDAT chunks of a PNG in blocks of at most DECOMPRESS_BLOCK_SIZE bytes
+
+    Stands in for `png.decompress`, which decompresses every chunk as a whole. Labels are mostly blank and compress
+    very well, so a chunk of some 100KB held megabytes of image data, more than the rest of stream_png together.
+    """
+    decompressor = zlib.decompressobj()
+    for data in data_blocks:
+        while data:
+            yield bytearray(decompressor.decompress(data, DECOMPRESS_BLOCK_SIZE))
+            data = decompressor.unconsumed_tail
+    yield bytearray(decompressor.flush())
+
+
+png.decompress = decompress_blocks
 
 
 def encode_png(image_path, target_height):
@@ -33,51 +256,154 @@ def encode_png(image_path, target_height):
     :param target_height: Height we expect the image to be for the given tape size
     """
 
-    margin = (128 - target_height) // 2
+    return encode_alpha(read_png_alpha(png.Reader(filename=image_path)), target_height)
+
+
+def stream_png(image_path, target_height, block_columns=STREAM_BLOCK_COLUMNS, trim: Trim = None, threshold=None):
+    """
+    Convert the PNG to compressed raster lines for printing, one block of columns at a time
+
+    Only the header is read before returning, so the print information command can be sent right away. While the
+    generator runs, the image is kept as one bit per pixel, decompressed in bounded blocks (see `decompress_blocks`),
+    and only one block of columns is encoded at a time. To
+    trim the label the whole image has to be read first, to know which columns have ink.
 
-    width, height, rows, info = png.Reader(filename=image_path).asRGBA()
+    :param image_path: Path to the PNG file to be printed
+    :param target_height: Height we expect the image to be for the given tape size
+    :param block_columns: Number of image columns to encode and compress at once, a multiple of 8
+    :param trim: How to trim the blank columns at both ends, None to send every column
+    :param threshold: Print the pixels darker than this instead if every pixel turns out to be opaque, like the 'auto'
+                      conversion. None prints by the alpha channel either way
+    :return: The number of raster lines, the number of lines left out by trimming, and a generator of compressed
+             raster data
+    """
+
+    reader = png.Reader(filename=image_path)
+    reader.preamble()
+    width, height = reader.width, reader.height
 
     if height != target_height:
-        sys.exit(f"Image height is {height} pixels, {target_height} required for the current media width")
+        raise ValueError(f"Image height is {height} pixels, {target_height} required for the current media width")
 
-    # get all the alpha channel values, rotate 90 degrees and flip horizontally
-    data = [row[3::4] for row in rows]
-    data = list(zip(*data))
+    if (PRINT_HEAD_DOTS - target_height) % 2:
+        # The lines don't fill whole bytes, so bits of one block would run on into the next
+        block_columns = width
 
-    buffer = bytearray()
+    def read_bitplane():
+        _, _, rows, info = reader.asRGBA()
+        shift = info['bitdepth'] - 8
+
+        bitplane = np.empty((height, (width + 7) // 8), dtype=np.uint8)
+        dark = np.empty_like(bitplane) if threshold is not None else None
+        opaque = True
+        for y, row in enumerate(rows):
+            pixels = np.asarray(row).reshape(-1, 4)
+            bitplane[y] = np.packbits(pixels[:, 3] > 0)
+            if dark is not None:
+                opaque = opaque and pixels[:, 3].min() == (1 << info['bitdepth']) - 1
+                rgb = (pixels[:, :3] >> shift if shift > 0 else pixels[:, :3]).astype(np.uint32)
+                # Pillow's conversion to greyscale, so streamed images print like converted ones
+                brightness = (rgb[:, 0] * 19595 + rgb[:, 1] * 38470 + rgb[:, 2] * 7471 + 0x8000) >> 16
+                dark[y] = np.packbits(brightness < threshold)
+        return dark if dark is not None and opaque else bitplane
+
+    def raster_blocks(bitplane, start, end, before, after):
+        if bitplane is None:
+            bitplane = read_bitplane()
+
+        if before:
+            yield ZERO_COMMAND * before
+        for block_start in range(start, end, block_columns):
+            block_end = min(block_start + block_columns, end)
+            offset = block_start % 8
+            alpha = np.unpackbits(bitplane[:, block_start // 8:(block_end + 7) // 8], axis=1)
+            yield compress(encode_alpha(alpha[:, offset:offset + block_end - block_start], target_height)).raster
+        if after:
+            yield ZERO_COMMAND * after
+
+    if trim is None:
+        return width, 0, raster_blocks(None, 0, width, 0, 0)
+
+    bitplane = read_bitplane()
+    inked = np.unpackbits(np.bitwise_or.reduce(bitplane, axis=0), count=width) > 0
+    start, end, before, after = trim_range(inked, trim)
+    lines = before + end - start + after
+    return lines, width - lines, raster_blocks(bitplane, start, end, before, after)
+
+
+def stream_image(image_path, target_height, trim: Trim = None, conversion: Conversion = None):
+    """
+    Convert an image file to compressed raster lines for printing, streamed from the file where possible
+
+    PNGs that have an alpha channel (or are printed by it) and the height of the tape are streamed with `stream_png`,
+    which prints them by brightness instead if 'auto' finds no transparent pixels. Other images are decoded by Pillow
+    and converted as a whole.
+
+    :param conversion: How the pixels are turned into dots, DEFAULT_CONVERSION if None
+    :return: The number of raster lines, the number of lines left out by trimming, and an iterable of compressed
+             raster data
+    """
+    conversion = conversion or DEFAULT_CONVERSION
+
+    if conversion.method in ('auto', 'alpha'):
+        reader = png.Reader(filename=image_path)
+        try:
+            reader.preamble()
+        except png.FormatError:
+            # Not a PNG
+            reader = None
+        if reader is not None and reader.height == target_height and \
+                (conversion.method == 'alpha' or reader.alpha or getattr(reader, 'trns', None)):
+            threshold = conversion.threshold if conversion.method == 'auto' else None
+            return stream_png(image_path, target_height, trim=trim, threshold=threshold)
+
+    payload = compress(encode_image(image_path, target_height, conversion), trim)
+    return payload.lines, payload.trimmed, [payload.raster]
+
+
+def encode_image(image, target_height, conversion: Conversion = None):
+    """
+    Convert an image to a raster for printing, without going through a file
+
+    :param image: A PIL image, a path to or the data of any image Pillow reads, as bytes or a file-like object, a 2D
+                  array of alpha values or an array of RGB or RGBA pixels
+    :param target_height: Height we expect the image to be for the given tape size
+    :param conversion: How the pixels are turned into dots, DEFAULT_CONVERSION if None
+    """
+
+    return encode_alpha(image_ink(image, target_height, conversion or DEFAULT_CONVERSION), target_height)
+
+
+def read_png_alpha(reader):
+    """Read all the alpha channel values of a PNG as a 2D array"""
+    width, height, rows, info = reader.asRGBA()
+
+    return np.vstack([np.asarray(row)[3::4] for row in rows])
+
+
+def encode_alpha(alpha, target_height):
+    """
+    Convert an alpha channel to a raster for printing
+
+    Every pixel that is not fully transparent is printed.
+
+    :param alpha: 2D array of alpha values, one row per image row
+    :param target_height: Height we expect the image to be for the given tape size
+    """
+
+    height = len(alpha)
+    if height != target_height:
+        raise ValueError(f"Image height is {height} pixels, {target_height} required for the current media width")
+
+    margin = (PRINT_HEAD_DOTS - target_height) // 2
+
+    # rotate 90 degrees and flip horizontally, so every line of the raster is one column of the image
+    lines = np.asarray(alpha).T > 0
+
+    # for < 24mm tapes the image is not a multiple of 8 bits high, so add the left and right margins (which are
+    # thankfully symmetric) before packing the bits
+    lines = np.pad(lines, ((0, 0), (margin, margin)))
 
-    # We need to bit stuff the image to get things to align as for < 24mm tapes, the image will not be a multiple of
-    # 8, and we also need to add a left and right margins which are thankfully symmetric
-    byte = 0
-    bits = 0
-    for line in data:
-        # Push in left margin bits
-        for _ in range(0, margin):
-            bits += 1
-
-            if bits == 8:
-                buffer.append(byte)
-                bits = 0
-                byte = 0
-
-        # Push in the image bits for this line of the image
-        for v in line:
-            if v > 0:
-                byte |= (1 << (7 - bits))
-            bits += 1
-
-            if bits == 8:
-                buffer.append(byte)
-                bits = 0
-                byte = 0
-
-        # Push in the right margin bits
-        for _ in range(0, margin):
-            bits += 1
-
-            if bits == 8:
-                buffer.append(byte)
-                bits = 0
-                byte = 0
-
-    return buffer
+    # The bits run on from one line into the next, only whole bytes are sent
+    bits = lines.ravel()
+    return bytearray(np.packbits(bits[:len(bits) - len(bits) % 8]).tobytes())
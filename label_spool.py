@@ -0,0 +1,205 @@
+import argparse
+import struct
+import sys
+import zlib
+from enum import IntFlag
+from typing import NamedTuple
+
+import app_args
+from config import get_default_bt
+from label_commands import build_label_job, send_buffer
+from label_maker import (PrinterError, bad_options, batch_labels, bt_socket_manager, connect_bluetooth,
+                         get_printer_info, label_cut, options_conversion, options_trim, template_payload,
+                         wait_for_completion)
+from label_rasterizer import TZE_DOTS, TrimStats, compress, encode_image, trim_stats
+
+MAGIC = b'PTSPOOL'
+VERSION = 1
+
+# Magic, version, media width in mm, SpoolFlags, number of pages, length and CRC-32 of the command stream, the raster
+# lines of all pages, the blank lines trimming left out of them and the number of trimmed pages
+HEADER = struct.Struct('<7sBBBHIIIiH')
+
+
+class SpoolFlags(IntFlag):
+    CUT_ALL = 0x01
+    CUT_NONE = 0x02
+    CHAIN_PRINTING = 0x04
+
+
+class SpoolError(ValueError):
+    """The file is not a spool file, or it doesn't fit the tape in the printer"""
+
+
+class Spool(NamedTuple):
+    """A print job compiled to the exact bytes sent to the printer, for one tape width"""
+    media_width: int
+    pages: int
+    flags: SpoolFlags
+    commands: bytes
+    # Totals for TrimStats
+    lines: int
+    trimmed: int
+    trimmed_pages: int
+
+    def describe(self):
+        if SpoolFlags.CUT_ALL in self.flags:
+            cut = 'cut after every label'
+        elif SpoolFlags.CUT_NONE in self.flags:
+            cut = 'no cuts'
+        else:
+            cut = 'cut after some labels'
+        chain = ', chain printing' if SpoolFlags.CHAIN_PRINTING in self.flags else ''
+        return f"{self.pages} labels for {self.media_width}mm tape, {cut}{chain}, {len(self.commands)} bytes"
+
+
+def compile_spool(pages, media_width, chain_printing=False) -> Spool:
+    """
+    Compile pages to the command stream that prints them
+
+    :param pages: List of (RasterPayload, cut) tuples, `cut` tells whether to cut after that page
+    :param media_width: Width of the tape in mm the job is for
+    :param chain_printing: Don't feed and cut after the last page, so the next job continues on the same tape
+    """
+    flags = SpoolFlags(0)
+    if all(cut for _, cut in pages):
+        flags |= SpoolFlags.CUT_ALL
+    elif not any(cut for _, cut in pages):
+        flags |= SpoolFlags.CUT_NONE
+    if chain_printing:
+        flags |= SpoolFlags.CHAIN_PRINTING
+
+    commands = bytes(build_label_job(pages, media_width, chain_printing).getvalue())
+    return Spool(media_width, len(pages), flags, commands, sum(payload.lines for payload, _ in pages),
+                 sum(payload.trimmed for payload, _ in pages), sum(payload.trimmed > 0 for payload, _ in pages))
+
+
+def write_spool(path, spool: Spool):
+    with open(path, 'wb') as fd:
+        fd.write(HEADER.pack(MAGIC, VERSION, spool.media_width, spool.flags, spool.pages, len(spool.commands),
+                             zlib.crc32(spool.commands), spool.lines, spool.trimmed, spool.trimmed_pages))
+        fd.write(spool.commands)
+
+
+def read_spool(path) -> Spool:
+    with open(path, 'rb') as fd:
+        data = fd.read()
+
+    if len(data) < HEADER.size:
+        raise SpoolError(f"{path} is too short to be a spool file")
+    magic, version, media_width, flags, pages, length, crc, lines, trimmed, trimmed_pages = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SpoolError(f"{path} is not a spool file")
+    if version != VERSION:
+        raise SpoolError(f"{path} has version {version}, only version {VERSION} is supported")
+
+    commands = data[HEADER.size:]
+    if len(commands) != length or zlib.crc32(commands) != crc:
+        raise SpoolError(f"{path} is truncated or corrupt")
+    if media_width not in TZE_DOTS:
+        raise SpoolError(f"{path} is for an unknown tape width of {media_width}mm")
+
+    return Spool(media_width, pages, SpoolFlags(flags), commands, lines, trimmed, trimmed_pages)
+
+
+def check_media_width(spool: Spool, media_width):
+    if media_width != spool.media_width:
+        raise SpoolError(f"The spool file is for {spool.media_width}mm tape, but the printer has {media_width}mm tape")
+
+
+def send_spool(socket, spool: Spool, media_width, printer_state=None):
+    """
+    Send a compiled job as is, after checking it was compiled for the tape in the printer
+
+    :param media_width: Width of the tape in mm, as reported by the printer
+    :param printer_state: PrinterState to update with the status packets sent while printing
+    :return: The ConnectionState the printer ended in
+    """
+    check_media_width(spool, media_width)
+    send_buffer(socket, spool.commands)
+    trim_stats.add(spool.pages, spool.trimmed_pages, spool.lines, spool.trimmed)
+
+    return wait_for_completion(socket, spool.pages, printer_state)
+
+
+def compile_command(options):
+    height = TZE_DOTS[options.media_width]
+    if options.template:
+        pages = [(template_payload(options, options.media_width), label_cut(options))]
+    else:
+        trim, conversion = options_trim(options), options_conversion(options)
+        pages = [(compress(encode_image(image, height, conversion), trim), cut)
+                 for image, cut in batch_labels(options, options.media_width)]
+    if not pages:
+        bad_options('Images, texts or a template to compile are required')
+
+    spool = compile_spool(pages, options.media_width, options.chain_printing)
+    write_spool(options.spool, spool)
+    print(f"Wrote {options.spool}: {spool.describe()}")
+    # Nothing is sent yet, report what trimming saves each time the file is sent
+    compiled = TrimStats()
+    compiled.record_pages(pages)
+    compiled.report()
+
+
+def send_command(options):
+    try:
+        spool = read_spool(options.spool)
+    except (OSError, SpoolError) as error:
+        bad_options(f"Could not read spool file: {error}")
+    print(spool.describe())
+
+    bt_address = options.bt_address or get_default_bt()
+    if not bt_address:
+        bad_options("BT Address is required. If you'd like to remember it use label_maker.py --set-default")
+
+    with bt_socket_manager(bt_address) as socket:
+        connect_bluetooth(socket, bt_address, options.bt_channel)
+        media_width = get_printer_info(socket).media_width
+        try:
+            send_spool(socket, spool, media_width)
+        except SpoolError as error:
+            bad_options(str(error))
+
+
+def info_command(options):
+    try:
+        print(f"{options.spool}: {read_spool(options.spool).describe()}")
+    except (OSError, SpoolError) as error:
+        bad_options(f"Could not read spool file: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compile labels to spool files ahead of time, and send them to the printer without rendering')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    compile_parser = commands.add_parser('compile', help='Render labels into a spool file')
+    compile_parser.add_argument('spool', help='Path of the spool file to write')
+    compile_parser.add_argument('--media-width', type=int, required=True, choices=sorted(TZE_DOTS),
+                                help='Width of the tape in mm the labels are for')
+    compile_parser.add_argument('--chain-printing', action='store_true',
+                                help="Don't feed and cut after the last label, so the next job continues on the tape")
+    app_args.add_label_args(compile_parser)
+    compile_parser.set_defaults(handler=compile_command)
+
+    send_parser = commands.add_parser('send', help='Print a spool file')
+    send_parser.add_argument('spool', help='Path of the spool file to print')
+    send_parser.add_argument('bt_address', nargs='?', help='Bluetooth address of device (eg. "EC:79:49:63:2A:80"), '
+                                                           'or "tcp:HOST:PORT" for the printer simulator')
+    send_parser.add_argument('--bt-channel', type=int, default=1, help='Bluetooth Channel to use')
+    send_parser.set_defaults(handler=send_command)
+
+    info_parser = commands.add_parser('info', help='Show what a spool file prints')
+    info_parser.add_argument('spool', help='Path of the spool file')
+    info_parser.set_defaults(handler=info_command)
+
+    options = parser.parse_args()
+    try:
+        options.handler(options)
+    except (PrinterError, ConnectionError, ValueError, ImportError) as error:
+        sys.exit(str(error))
+
+
+if __name__ == "__main__":
+    main()
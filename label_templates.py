@@ -0,0 +1,225 @@
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+try:
+    import yaml
+except ImportError:
+    # Only needed for templates written in YAML, JSON templates work without it
+    yaml = None
+
+from image_conversion import DEFAULT_THRESHOLD, Conversion, image_ink
+from image_generator import FONT_PATH
+from label_rasterizer import CHUNK_SIZE, TZE_DOTS, RasterPayload, compress, encode_alpha
+from text_layout import DOTS_PER_MM, layout_text, render_layout
+
+STATIC_ELEMENT_TYPES = ('border', 'line', 'image', 'text')
+
+
+class TemplateError(ValueError):
+    """The template is invalid, or values for its fields are missing"""
+
+
+class LabelTemplate:
+    """
+    A label with static elements (images, borders, lines and fixed text) and variable text fields
+
+    Templates are JSON (or YAML) objects::
+
+        {
+            "length": 50,
+            "font": "/usr/share/fonts/truetype/freefont/FreeSans.ttf",
+            "elements": [
+                {"type": "border", "thickness": 2},
+                {"type": "image", "path": "logo.png", "x": 1, "width": 8},
+                {"type": "line", "x": 10},
+                {"type": "text", "text": "**RACK**", "x": 11, "width": 12},
+                {"type": "field", "text": "{row}-{slot}", "x": 23, "width": 26, "max_lines": 1}
+            ]
+        }
+
+    `x`, `width` and `length` are in mm along the label. `y` and `height` are the part of the tape height an element
+    takes (0 to 1, the whole height by default), so a template works on every tape width. Text may use the
+    text_layout markup and is fitted into its box. Fields are `str.format` strings filled in with the values at print
+    time. Images are printed by their alpha channel, or by brightness without one; `conversion` and `threshold` pick
+    another image_conversion.Conversion method, e.g. `"conversion": "ordered"` for a photo.
+
+    The static elements are rendered once per tape width and kept as encoded raster lines, printing a label only
+    renders its fields and merges them in.
+    """
+
+    def __init__(self, definition, directory='.'):
+        """
+        :param definition: The parsed template
+        :param directory: Directory relative image paths are resolved against
+        """
+        self.directory = directory
+        self.font_path = definition.get('font', FONT_PATH)
+        self.elements = definition.get('elements', [])
+
+        for element in self.elements:
+            if element.get('type') not in STATIC_ELEMENT_TYPES + ('field',):
+                raise TemplateError(f"Unknown element type {element.get('type')!r}")
+
+        self.fields = [element for element in self.elements if element['type'] == 'field']
+        self.length = definition.get('length') or max(
+            (element.get('x', 0) + element.get('width', 0) for element in self.elements), default=0)
+        if self.length <= 0:
+            raise TemplateError("The template needs a length, or elements with a width")
+
+        self.static_layers = {}
+        self.lock = threading.Lock()
+        # The file the template was loaded from and its modification time, to tell rendered labels apart in caches
+        self.source = None
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as fd:
+            if path.endswith(('.yaml', '.yml')):
+                if yaml is None:
+                    raise TemplateError("Reading YAML templates requires PyYAML")
+                definition = yaml.safe_load(fd)
+            else:
+                definition = json.load(fd)
+
+        template = cls(definition, os.path.dirname(os.path.abspath(path)))
+        template.source = (os.path.abspath(path), os.stat(path).st_mtime)
+        return template
+
+    @property
+    def width(self):
+        """Length of the label in dots"""
+        return to_dots(self.length)
+
+    def box(self, element, height):
+        """The (x, y, width, height) of an element in dots, clipped to the label"""
+        x = min(to_dots(element.get('x', 0)), self.width)
+        width = min(to_dots(element.get('width', self.length - element.get('x', 0))), self.width - x)
+        y = min(round(element.get('y', 0) * height), height)
+        box_height = min(round(element.get('height', 1) * height), height - y)
+        return x, y, width, box_height
+
+    def static_layer(self, height):
+        """The encoded raster lines of the static elements, as a (width, CHUNK_SIZE) array, rendered once per height"""
+        with self.lock:
+            if height not in self.static_layers:
+                canvas = np.zeros((height, self.width), dtype=bool)
+                for element in self.elements:
+                    if element['type'] != 'field':
+                        self._draw(canvas, element, height)
+
+                layer = np.frombuffer(bytes(encode_alpha(canvas, height)), dtype=np.uint8)
+                self.static_layers[height] = layer.reshape(self.width, CHUNK_SIZE)
+
+            return self.static_layers[height]
+
+    def _draw(self, canvas, element, height):
+        x, y, width, box_height = self.box(element, height)
+        if not width or not box_height:
+            return
+
+        if element['type'] == 'border':
+            thickness = element.get('thickness', 1)
+            canvas[:thickness, :] = canvas[-thickness:, :] = True
+            canvas[:, :thickness] = canvas[:, -thickness:] = True
+        elif element['type'] == 'line':
+            thickness = element.get('thickness', 1)
+            canvas[y:y + box_height, x:x + thickness] = True
+        elif element['type'] == 'image':
+            ink = self._image(element, width, box_height)
+            self._place(canvas, ink, x, y, width, box_height, element.get('align', 'center'))
+        elif element['type'] == 'text':
+            ink = self._text(element['text'], element, width, box_height)
+            self._place(canvas, ink, x, y, width, box_height, element.get('align', 'center'))
+
+    def _image(self, element, width, height):
+        """The image scaled to fit the box, as ink (alpha, or dark pixels for images without alpha by default)"""
+        image = Image.open(os.path.join(self.directory, element['path']))
+        scale = min(width / image.width, height / image.height)
+        image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+
+        return image_ink(image, conversion=Conversion(element.get('conversion', 'auto'),
+                                                      element.get('threshold', DEFAULT_THRESHOLD)))
+
+    def _text(self, text, element, width, height):
+        layout = layout_text(text, height, self.font_path, width, element.get('max_lines'))
+        return np.asarray(render_layout(layout).getchannel('A')) > 0
+
+    @staticmethod
+    def _place(canvas, ink, x, y, width, height, align):
+        """Copy ink into the box on the canvas, centred vertically and aligned horizontally"""
+        ink = ink[:height, :width]
+        if align == 'left':
+            left = x
+        elif align == 'right':
+            left = x + width - ink.shape[1]
+        else:
+            left = x + (width - ink.shape[1]) // 2
+        top = y + (height - ink.shape[0]) // 2
+        canvas[top:top + ink.shape[0], left:left + ink.shape[1]] |= ink
+
+    def render(self, values, height) -> RasterPayload:
+        """
+        Render a label with its fields filled in, ready to print
+
+        :param values: Dict of the values for the fields
+        :param height: Number of dots of the tape, see TZE_DOTS
+        """
+        return compress(self.encode(values, height).tobytes())
+
+    def encode(self, values, height):
+        """The encoded raster lines of a label with its fields filled in, as a (width, CHUNK_SIZE) array"""
+        raster = self.static_layer(height).copy()
+
+        for field in self.fields:
+            try:
+                text = field['text'].format(**values)
+            except KeyError as error:
+                raise TemplateError(f"No value for field {error}") from error
+
+            x, y, width, box_height = self.box(field, height)
+            if not text or not width or not box_height:
+                continue
+
+            # Only the columns of the field are encoded, every column is one raster line
+            strip = np.zeros((height, width), dtype=bool)
+            self._place(strip, self._text(text, field, width, box_height), 0, y, width, box_height,
+                        field.get('align', 'center'))
+            raster[x:x + width] |= np.frombuffer(bytes(encode_alpha(strip, height)), dtype=np.uint8).reshape(
+                width, CHUNK_SIZE)
+
+        return raster
+
+
+def to_dots(mm):
+    return round(mm * DOTS_PER_MM)
+
+
+def preview(raster, height) -> Image.Image:
+    """Turn encoded raster lines back into an image, to check a template without printing it"""
+    bits = np.unpackbits(raster, axis=1)
+    margin = (CHUNK_SIZE * 8 - height) // 2
+    return Image.fromarray(np.where(bits[:, margin:margin + height].T, 0, 255).astype(np.uint8))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render a label template to a PNG, to check it without printing')
+    parser.add_argument('template', help='Path to a JSON or YAML template')
+    parser.add_argument('--field', action='append', default=[], metavar='NAME=VALUE', help='Value of a field')
+    parser.add_argument('--media-width', type=int, default=12, choices=sorted(TZE_DOTS), help='Tape width in mm')
+    parser.add_argument('--output', default='preview.png', help='Path of the PNG to write')
+    options = parser.parse_args()
+
+    height = TZE_DOTS[options.media_width]
+    template = LabelTemplate.load(options.template)
+    values = dict(field.split('=', 1) for field in options.field)
+    preview(template.encode(values, height), height).save(options.output)
+    print(f"Wrote {options.output} ({template.width}x{height} dots)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,283 @@
 import paho.mqtt.client as mqtt
 
+import base64
+import binascii
+import hashlib
+import json
 import subprocess
 import os
+import time
+import uuid
 import app_args_mqtt
 
 from config import set_defaults, get_defaults
-from label_maker import bad_options, get_printer_info, make_label, bt_socket_manager, get_media_height,connect_bluetooth
-from image_generator import text_to_image, calculate_font_size
+from font_metrics import font_size
+from label_maker import ConnectionState, PhaseType, StatusType, bad_options, options_conversion, options_trim, \
+    status_errors
+from image_generator import FONT_PATH
+from label_cache import PayloadCache, payload_key
+from label_templates import LabelTemplate, TemplateError
+from label_rasterizer import DEFAULT_TRIM, TZE_DOTS, trim_stats
+from print_scheduler import PRIORITY_BULK, PRIORITY_NORMAL, PRIORITY_URGENT
+from print_worker import JobError, PrintJob, PrintWorker
+from printer_pool import PrinterPool
+from printer_session import PrinterSession
+from render_pool import RenderPool
+from text_layout import DOTS_PER_MM
+
+# Keys of a JSON message that describe the job, with --template any other keys are values for its fields
+JOB_KEYS = ('id', 'text', 'template', 'fields', 'image', 'copies', 'cut', 'priority', 'tape')
+
+PRIORITIES = {'bulk': PRIORITY_BULK, 'normal': PRIORITY_NORMAL, 'urgent': PRIORITY_URGENT}
+
+# Most copies of a label one message can ask for
+MAX_COPIES = 100
 
 def on_connect(client, userdata, flags, rc):
     print("Connected with result code "+str(rc))
-    client.subscribe("label/print")
+    client.subscribe(userdata.topic)
 
 def on_message(client, userdata, msg):
-    with bt_socket_manager() as socket:
-        text = msg.payload.decode()
-        print("Print message: " + text)
-        print(userdata.bt_address)
-        socket = connect_bluetooth(socket, userdata.bt_address, userdata.bt_channel);
-    
-        get_printer_info(socket);
-        height = get_media_height();
+    try:
+        job = parse_job(msg.payload)
+    except ValueError as error:
+        print(f"Invalid message {message_id(msg.payload)}: {error}")
+        userdata.publish(PrintJob(job_id=message_id(msg.payload)), 'error', error=f"Invalid message: {error}")
+        return
+
+    print(f"Print message {job.job_id}")
+    media_widths = userdata.worker.pool.media_widths()
+    if job.media_width is not None and job.media_width not in media_widths:
+        print(f"No printer has {job.media_width}mm tape, dropping job {job.job_id}")
+        userdata.publish(job, 'error', error=f"No printer has {job.media_width}mm tape")
+        return
+
+    scheduled = userdata.worker.submit(job)
+    if scheduled is not None:
+        userdata.prefetch(scheduled, [job.media_width] if job.media_width is not None else media_widths)
+
+    if scheduled is job:
+        userdata.publish(job, 'queued')
+    elif scheduled is not None:
+        # An identical label is already waiting, it is printed once more as part of that job
+        userdata.publish(job, 'queued', merged_into=scheduled.job_id, copies=scheduled.copies)
+    else:
+        userdata.publish(job, 'error', error="Print queue full")
+
+def message_id(payload):
+    """The id of a message that could not be parsed as a job, if it has one"""
+    try:
+        return str(json.loads(payload)['id'])
+    except (ValueError, TypeError, KeyError):
+        return None
+
+def parse_job(payload):
+    """
+    A PrintJob from a message, either plain text or a JSON object like
+
+        {"id": "42", "text": "Hello", "copies": 2, "cut": false, "priority": "urgent", "tape": 12}
+        {"template": "rack", "fields": {"row": 3, "slot": 12}}
+        {"image": "<base64 encoded PNG, JPEG or other image>"}
+
+    The priority is a number, higher is printed first, or one of PRIORITIES. `tape` is the width in mm of the tape the
+    label must be printed on, any printer takes it without.
+    """
+    text = payload.decode()
+    try:
+        message = json.loads(text)
+    except ValueError:
+        message = None
+    if not isinstance(message, dict):
+        return PrintJob(text, job_id=uuid.uuid4().hex, key=job_key(text=text))
+
+    fields = message.get('fields')
+    if fields is None and not any(key in message for key in ('text', 'image', 'template')):
+        # Only the values for the fields of the --template
+        fields = {key: value for key, value in message.items() if key not in JOB_KEYS}
+
+    text = message.get('text')
+    template = message.get('template')
+    for name, value, value_type in (('text', text, str), ('template', template, str), ('fields', fields, dict),
+                                    ('image', message.get('image'), str)):
+        if value is not None and not isinstance(value, value_type):
+            raise ValueError(f"{name} must be a {'JSON object' if value_type is dict else 'string'}")
+
+    try:
+        image = base64.b64decode(message['image'], validate=True) if 'image' in message else None
+    except binascii.Error as error:
+        raise ValueError(f"image is not base64 encoded: {error}") from error
+
+    copies = message.get('copies', 1)
+    if not is_integer(copies) or not 1 <= copies <= MAX_COPIES:
+        raise ValueError(f"copies must be a number from 1 to {MAX_COPIES}, not {copies!r}")
+    priority = message.get('priority', PRIORITY_NORMAL)
+    priority = PRIORITIES.get(priority, priority) if isinstance(priority, str) else priority
+    if not is_integer(priority):
+        raise ValueError(f"priority must be a number or one of {', '.join(PRIORITIES)}, not {priority!r}")
+    media_width = message.get('tape')
+    if media_width is not None and (not is_integer(media_width) or media_width not in TZE_DOTS):
+        raise ValueError(f"tape must be one of {', '.join(map(str, TZE_DOTS))} (mm), not {media_width!r}")
+    cut = parse_flag(message.get('cut', True), 'cut')
+
+    return PrintJob(text, job_id=str(message.get('id') or uuid.uuid4().hex), template=template, fields=fields,
+                    image=image, copies=copies, cut=cut, priority=priority, media_width=media_width,
+                    key=job_key(text, template, fields, image, cut))
+
+def is_integer(value):
+    # JSON true and false are bools, which are ints to Python
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def parse_flag(value, name):
+    """A JSON boolean, or the strings "true" and "false" some senders (e.g. templated automations) send instead"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    raise ValueError(f"{name} must be true or false, not {value!r}")
+
+def job_key(text=None, template=None, fields=None, image=None, cut=True):
+    """Identifies the label a job prints, jobs with the same key render the same payload on the same tape"""
+    content = {'text': text, 'template': template, 'fields': fields, 'cut': cut,
+               'image': hashlib.sha256(image).hexdigest() if image is not None else None}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+def make_publisher(client, topic):
+    def publish(job, state, **details):
+        """Report the state of a job on the result topic, for every message merged into it"""
+        for job_id in [job.job_id] + job.merged_ids:
+            message = {'id': job_id, 'state': state, 'timestamp': time.time(), **details}
+            client.publish(topic, json.dumps(message))
+
+    return publish
+
+def make_print_job(renderer, publish, font_path=FONT_PATH, max_length=None, max_lines=None, template=None,
+                   template_dir=None, trim=DEFAULT_TRIM, conversion=None):
+    """
+    The functions that render and print jobs
+
+    :param renderer: The RenderPool labels are rendered with
+    :param trim: How to trim the blank columns at both ends of texts and images, templates keep their length
+    :param conversion: How the pixels of images are turned into dots, see image_conversion.Conversion
+    :return: (print_job, prefetch), `prefetch` starts rendering a job for the given tape widths as soon as it is queued
+    """
+    templates = {}
+
+    def load_template(name):
+        if name is None:
+            if template is None:
+                raise TemplateError("No template given, and none set with --template")
+            return template
+        if template_dir is None:
+            raise TemplateError("Templates can only be picked by name with --template-dir")
+        if name not in templates:
+            # Templates are looked up by name only, so messages can't read files outside the directory
+            templates[name] = LabelTemplate.load(os.path.join(template_dir, os.path.basename(name) + '.json'))
+        return templates[name]
+
+    def label_task(job, height):
+        """The payload cache key of a job's label, and the arguments of `render_label` that render it"""
+        if job.image is not None:
+            key = (hashlib.sha256(job.image).hexdigest(), height, trim, conversion)
+            return key, ('image', job.image, height, trim, conversion)
+        elif job.fields is not None or job.template is not None:
+            label_template = load_template(job.template)
+            key = (label_template.source, json.dumps(job.fields, sort_keys=True), height)
+            return key, ('template', label_template.source + (job.fields or {},), height)
+        elif job.text is not None:
+            key = payload_key(job.text, height, font_path, font_size(font_path, height), max_length,
+                              max_lines) + (trim,)
+            return key, ('text', job.text, height, trim, None, font_path, max_length, max_lines)
+        raise ValueError("The message has no text, template or image")
+
+    def prefetch(job, media_widths):
+        """Render the label of a queued job for every tape width, while the printers are busy"""
+        for media_width in media_widths:
+            try:
+                key, task = label_task(job, TZE_DOTS[media_width])
+            except (ValueError, OSError):
+                # Reported when the job is printed
+                return
+            renderer.prefetch(key, task, job.timings)
+
+    def print_job(session, job):
+        """Render and print a queued job, only called from the print worker threads"""
+        job.timings['queue'] = time.monotonic() - job.queued_at
+        # Left over from an attempt on another printer
+        job.timings.pop('error', None)
+        print(session.bt_address)
+        session.ensure_connected()
+
+        height = session.media_height;
         print("Media height: " + str(height))
-        image = text_to_image(text,height)
-        imageLocation = "text.png";
-        image.save(imageLocation)
-        userdata.image = imageLocation
-        make_label(userdata, socket)
+        try:
+            key, task = label_task(job, height)
+            payload = renderer.render(key, task, job.timings)
+        except (ValueError, OSError) as error:
+            # A bad message, not a printer problem, e.g. an image that doesn't fit the tape or a missing template
+            raise JobError(f"Could not render label: {error}") from error
+
+        printing = []
+
+        def on_status(status):
+            if status.status_type == StatusType.PHASE_CHANGE and status.phase_type == PhaseType.PRINTING_STATE:
+                # The phase changes for every copy, only the first one is reported
+                if not printing:
+                    printing.append(True)
+                    publish(job, 'printing', printer=session.bt_address)
+            elif status.status_type == StatusType.ERROR_OCCURRED:
+                job.timings['error'] = status_errors(status)
+
+        session.state.subscribe(on_status)
+        start = time.monotonic()
+        try:
+            state = session.print_pages([(payload, job.cut)] * job.copies)
+        finally:
+            session.state.unsubscribe(on_status)
+        job.timings['transfer'] = session.last_transfer_seconds
+        job.timings['print'] = time.monotonic() - start - session.last_transfer_seconds
+
+        if state == ConnectionState.DISCONNECTED:
+            # Let the worker give the label to another printer
+            raise ConnectionError(f"{session.bt_address} turned off before printing the label")
+
+        publish(job, 'completed', printer=session.bt_address, copies=job.copies, timings=job.timings)
+
+        stats = renderer.cache.stats()
+        print(f"Label cache: {stats['hits']} hits, {stats['misses']} misses, {stats['size']} labels cached")
+        stats = renderer.stats()
+        print(f"Rendering: {stats['prefetched']} prefetched, {stats['ready']} ready in time, {stats['waited']} waited "
+              f"for ({stats['wait_seconds']:.2f}s), {stats['rendered']} rendered on demand")
+        trim_stats.report()
+
+    return print_job, prefetch
 
 def connect_and_listen(options):
     client = mqtt.Client(userdata=options)
     client.on_connect = on_connect
     client.on_message = on_message
+    options.publish = make_publisher(client, options.result_topic)
+
+    def on_failure(job, error):
+        if isinstance(error, JobError):
+            options.publish(job, 'error', error=str(error), timings=job.timings)
+            return
+        # The error flags of a PrinterError were kept when the status came in
+        reason = job.timings.pop('error', None) or str(error)
+        options.publish(job, 'error', error=f"Printing failed: {reason}", timings=job.timings)
+
+    pool = PrinterPool(options.bt_address, options.bt_channel)
+    renderer = RenderPool(PayloadCache(options.cache_size, options.cache_dir), options.render_workers)
+    max_length = round(options.max_length * DOTS_PER_MM) if options.max_length else None
+    template = LabelTemplate.load(options.template) if options.template else None
+    print_job, options.prefetch = make_print_job(renderer, options.publish, options.font, max_length,
+                                                 options.max_lines, template, options.template_dir,
+                                                 options_trim(options), options_conversion(options))
+
+    def on_report(stats):
+        client.publish(options.stats_topic, json.dumps({**stats, 'trim': trim_stats.stats()}), retain=True)
+
+    options.worker = PrintWorker(pool, print_job, options.queue_size, on_failure, options.dedup_window, on_report)
+    options.worker.start()
 
     if options.mqtt_user and options.mqtt_password:
         client.username_pw_set(options.mqtt_user, options.mqtt_password)
@@ -55,7 +301,7 @@ def main():
 
         else:
             set_defaults(options.bt_address,options.mqtt_host,options.mqtt_port,options.mqtt_password,options.mqtt_user)
-            print(f"{options.bt_address} set as default BT address")
+            print(f"{', '.join(options.bt_address)} set as default BT address")
             print(f"{options.mqtt_host} set as default MQTT host")
             print(f"{options.mqtt_port} set as default MQTT port")
 
@@ -65,10 +311,10 @@ def main():
                 print(f"{options.mqtt_password} set as default MQTT Password")
 
     if not options.bt_address:        
-        if not 'default_bt' in defaults:
+        if not defaults['printers'] and not defaults['default_bt']:
             bad_options("BT Address is required. If you'd like to remember it use --set-default")
-        options.bt_address = defaults['default_bt'];
-        print(f"Using BT Address of {options.bt_address}")
+        options.bt_address = defaults['printers'] or [defaults['default_bt']];
+        print(f"Using BT Address of {', '.join(options.bt_address)}")
     
     if not options.mqtt_host:
         if not 'host' in defaults:
@@ -93,7 +339,9 @@ def main():
             print(f"Using MQTT Password of {options.mqtt_password}")
         
     if options.info:
-        get_printer_info(options.bt_address, options.bt_channel)
+        for bt_address in options.bt_address:
+            with PrinterSession(bt_address, options.bt_channel):
+                pass
         exit(0)
     
     connect_and_listen(options)
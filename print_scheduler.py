@@ -0,0 +1,152 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+
+# Seconds an identical job can arrive after a pending one and still be merged into it
+DEFAULT_DEDUP_WINDOW = 10
+
+# Priorities of the jobs in a MQTT message, higher numbers are printed first
+PRIORITY_BULK = -1
+PRIORITY_NORMAL = 0
+PRIORITY_URGENT = 1
+
+
+class PrintScheduler:
+    """
+    The queue of jobs waiting for a printer, by priority
+
+    Jobs with a higher priority are handed out first, jobs with the same priority in the order they came in. A job that
+    is identical to a pending one (same `key` and tape width) queued less than `dedup_window` seconds earlier is not
+    queued again, its copies are added to the pending job instead. A merged job takes the higher of both priorities.
+
+    Has the part of the `queue.Queue` interface PrintWorker uses: `put_nowait`, `get`, `task_done`, `join` and `qsize`.
+    """
+
+    def __init__(self, maxsize=0, dedup_window=DEFAULT_DEDUP_WINDOW):
+        """
+        :param maxsize: Number of pending jobs before `put_nowait` raises queue.Full, 0 for no limit
+        :param dedup_window: Seconds identical jobs are merged within, 0 to never merge
+        """
+        self.maxsize = maxsize
+        self.dedup_window = dedup_window
+        self.heap = []
+        # Heap entries of the pending jobs by their key, to find the job a duplicate is merged into
+        self.pending = {}
+        self.counter = itertools.count()
+        self.unfinished = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.merged = 0
+        self.merged_copies = 0
+        self.handed_out = {}
+        self.wait_seconds = {}
+
+    def qsize(self):
+        with self.condition:
+            return len(self.pending_jobs())
+
+    def pending_jobs(self):
+        return [entry[2] for entry in self.heap if entry[2] is not None]
+
+    def put_nowait(self, job):
+        """
+        Queue a job, or merge it into an identical pending one
+
+        :return: The job that will print it, `job` itself or the pending job it was merged into
+        :raises queue.Full: When there are `maxsize` pending jobs
+        """
+        with self.condition:
+            key = self._key(job)
+            entry = self.pending.get(key)
+            if entry is not None and time.monotonic() - entry[2].queued_at < self.dedup_window:
+                return self._merge(entry, job)
+
+            depth = len(self.pending_jobs())
+            if self.maxsize and depth >= self.maxsize:
+                raise queue.Full
+
+            self._push(job)
+            self.unfinished += 1
+            self.condition.notify()
+            return job
+
+    def _key(self, job):
+        # Jobs without a key are never merged
+        return (job.key, job.media_width) if job.key is not None else None
+
+    def _push(self, job):
+        entry = [-job.priority, next(self.counter), job]
+        heapq.heappush(self.heap, entry)
+        if self._key(job) is not None:
+            self.pending[self._key(job)] = entry
+
+    def _merge(self, entry, job):
+        pending = entry[2]
+        pending.copies += job.copies
+        pending.merged_ids.append(job.job_id)
+        pending.merged_ids.extend(job.merged_ids)
+        self.merged += 1
+        self.merged_copies += job.copies
+
+        if job.priority > pending.priority:
+            # Queue it again at the new priority, the old entry is skipped when it comes up
+            entry[2] = None
+            pending.priority = job.priority
+            self._push(pending)
+        return pending
+
+    def get(self):
+        """Wait for the next job, None once the scheduler is closed and empty"""
+        with self.condition:
+            while True:
+                while self.heap and self.heap[0][2] is None:
+                    heapq.heappop(self.heap)
+                if self.heap:
+                    break
+                if self.closed:
+                    return None
+                self.condition.wait()
+
+            job = heapq.heappop(self.heap)[2]
+            if self.pending.get(self._key(job), [None, None, None])[2] is job:
+                # Later duplicates can't be merged into a job that is printing
+                del self.pending[self._key(job)]
+
+            self.handed_out[job.priority] = self.handed_out.get(job.priority, 0) + 1
+            self.wait_seconds[job.priority] = (self.wait_seconds.get(job.priority, 0.0) +
+                                               time.monotonic() - job.queued_at)
+            return job
+
+    def task_done(self):
+        with self.condition:
+            self.unfinished -= 1
+            if not self.unfinished:
+                self.condition.notify_all()
+
+    def join(self):
+        """Wait until every queued job was handed out and marked done"""
+        with self.condition:
+            while self.unfinished:
+                self.condition.wait()
+
+    def close(self):
+        """Let `get` return None once the pending jobs are handed out"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            depth = {}
+            for job in self.pending_jobs():
+                depth[job.priority] = depth.get(job.priority, 0) + 1
+
+            return {
+                'depth_by_priority': depth,
+                'merged': self.merged,
+                'merged_copies': self.merged_copies,
+                'average_wait_by_priority': {priority: self.wait_seconds[priority] / count
+                                             for priority, count in self.handed_out.items()},
+            }
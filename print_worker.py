@@ -0,0 +1,202 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+
+from print_scheduler import DEFAULT_DEDUP_WINDOW, PrintScheduler
+
+DEFAULT_QUEUE_SIZE = 32
+
+# Number of printers a job is tried on before it counts as failed
+MAX_ATTEMPTS = 2
+
+
+class JobError(Exception):
+    """The job itself can't be printed, e.g. its label can't be rendered. It fails without trying another printer"""
+
+
+@dataclass
+class PrintJob:
+    text: str = None
+    media_width: int = None
+    queued_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+    job_id: str = None
+    template: str = None
+    fields: dict = None
+    image: bytes = None
+    copies: int = 1
+    cut: bool = True
+    priority: int = 0
+    # Identical jobs have the same key and are merged while pending, None to never merge
+    key: str = None
+    # Ids of the jobs merged into this one, they are printed as extra copies
+    merged_ids: list = field(default_factory=list)
+    # Seconds spent in each stage, filled in while the job is processed
+    timings: dict = field(default_factory=dict)
+
+
+class PrintWorker:
+    """
+    The threads that own the printers, one per printer in the pool
+
+    Jobs are put on a bounded PrintScheduler by `submit`, which never blocks. When the queue is full the job is dropped
+    and counted, so the caller (e.g. the MQTT network loop) is never held up by the printers.
+    """
+
+    def __init__(self, pool, handler, max_queue_size=DEFAULT_QUEUE_SIZE, on_failure=None,
+                 dedup_window=DEFAULT_DEDUP_WINDOW, on_report=None):
+        """
+        :param pool: The PrinterPool the jobs are printed on
+        :param handler: Callable taking a PrinterSession and a PrintJob, which renders and prints the job. It raises
+                        JobError for jobs that can't be printed on any printer
+        :param max_queue_size: Number of jobs that can wait before new jobs are dropped
+        :param on_failure: Callable taking a PrintJob and the error, called when a job failed on every attempt
+        :param dedup_window: Seconds identical jobs are merged within, see PrintScheduler
+        :param on_report: Callable taking the stats, called after every finished job
+        """
+        self.pool = pool
+        self.handler = handler
+        self.on_failure = on_failure
+        self.on_report = on_report
+        self.jobs = PrintScheduler(max_queue_size, dedup_window)
+        self.threads = [threading.Thread(target=self.run, name=f"print-worker-{index}", daemon=True)
+                        for index in range(len(pool))]
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.max_depth = 0
+        self.total_wait_seconds = 0.0
+        self.last_wait_seconds = 0.0
+
+    def submit(self, job: PrintJob):
+        """
+        Queue a job without blocking
+
+        :return: The job that will print it, `job` or an identical pending job it was merged into. None if it was
+        dropped because the queue is full
+        """
+        try:
+            scheduled = self.jobs.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            print(f"Print queue full ({self.jobs.maxsize} jobs), dropping job: {job.text}")
+            return None
+
+        with self.lock:
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self.jobs.qsize())
+        if scheduled is not job:
+            print(f"Job {job.job_id} merged into pending job {scheduled.job_id}, {scheduled.copies} copies")
+        return scheduled
+
+    def start(self):
+        self.pool.connect()
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """Finish the queued jobs and stop the workers"""
+        # Wait for the queue to drain first, retried jobs are queued again and must still be handed out
+        self.jobs.join()
+        self.jobs.close()
+        for thread in self.threads:
+            thread.join()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            try:
+                self._process(job)
+            finally:
+                self.jobs.task_done()
+
+    def _process(self, job):
+        """Print one job, the end of the queue is handled by `run`"""
+        wait = time.monotonic() - job.queued_at
+        if job.media_width is not None and job.media_width not in self.pool.media_widths():
+            # The tape was changed since the job was queued, don't hold up a worker until someone changes it back
+            self._finish(job, wait, LookupError(f"No printer has {job.media_width}mm tape"))
+            return
+
+        session = self.pool.acquire(job.media_width)
+        job.attempts += 1
+        printer_failed = False
+        try:
+            self.handler(session, job)
+            error = None
+        except JobError as exception:
+            # Nothing was sent, the printer is fine
+            print(f"Print job {job.job_id} failed: {exception}")
+            error = exception
+        except Exception as exception:
+            print(f"Print job failed on {session.bt_address}: {exception}")
+            session.close()
+            error = exception
+            printer_failed = True
+        finally:
+            self.pool.release(session, failed=printer_failed)
+
+        if printer_failed and job.attempts < min(len(self.pool), MAX_ATTEMPTS) and self._retry(job):
+            return
+
+        self._finish(job, wait, error)
+
+    def _finish(self, job, wait, error=None):
+        """Count a job that is done, `error` is why it failed"""
+        succeeded = error is None
+        with self.lock:
+            self.last_wait_seconds = wait
+            self.total_wait_seconds += wait
+            if succeeded:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+        if not succeeded and self.on_failure is not None:
+            self.on_failure(job, error)
+
+        self.report()
+
+    def _retry(self, job):
+        """Give another printer a go, the failed one is out of rotation now"""
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            return False
+
+        with self.lock:
+            self.retried += 1
+        return True
+
+    def stats(self):
+        with self.lock:
+            processed = self.completed + self.failed
+            return {
+                'depth': self.jobs.qsize(),
+                'max_depth': self.max_depth,
+                'submitted': self.submitted,
+                'dropped': self.dropped,
+                'completed': self.completed,
+                'failed': self.failed,
+                'retried': self.retried,
+                'last_wait_seconds': self.last_wait_seconds,
+                'average_wait_seconds': self.total_wait_seconds / processed if processed else 0.0,
+                **self.jobs.stats(),
+            }
+
+    def report(self):
+        stats = self.stats()
+        print(f"Queue depth {stats['depth']} (max {stats['max_depth']}), waited {stats['last_wait_seconds']:.2f}s "
+              f"(average {stats['average_wait_seconds']:.2f}s), {stats['completed']} completed, "
+              f"{stats['failed']} failed, {stats['retried']} retried, {stats['dropped']} dropped, "
+              f"{stats['merged']} merged")
+        if self.on_report is not None:
+            self.on_report(stats)
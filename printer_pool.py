@@ -0,0 +1,112 @@
+import threading
+import time
+
+from label_rasterizer import TZE_DOTS
+from printer_session import PrinterSession
+
+# Seconds a failed printer stays out of rotation before it is tried again
+DEFAULT_RETRY_SECONDS = 30
+
+
+class PrinterPool:
+    """
+    A set of printers that jobs are spread over
+
+    Each printer has its own PrinterSession. A job gets an idle printer with the tape width it needs, and a printer that
+    fails or turns off is taken out of rotation for a while.
+    """
+
+    def __init__(self, bt_addresses, bt_channel=1, retry_seconds=DEFAULT_RETRY_SECONDS):
+        # Try to connect once, so one printer that is turned off does not hold up the others
+        self.sessions = [PrinterSession(bt_address, bt_channel, connect_attempts=1) for bt_address in bt_addresses]
+        self.retry_seconds = retry_seconds
+        self.idle = list(self.sessions)
+        self.retry_at = {}
+        self.jobs = {session: 0 for session in self.sessions}
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def connect(self):
+        """Connect every printer in parallel to learn their tape widths, failed printers are taken out of rotation"""
+        def connect(session):
+            try:
+                session.ensure_connected()
+            except Exception as error:
+                print(f"Could not connect to {session.bt_address}: {error}")
+                self._take_out_of_rotation(session)
+
+        threads = [threading.Thread(target=connect, args=(session,)) for session in self.sessions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _take_out_of_rotation(self, session):
+        with self.condition:
+            self.retry_at[session] = time.monotonic() + self.retry_seconds
+        print(f"Printer {session.bt_address} out of rotation for {self.retry_seconds}s")
+
+    def _available(self, session, media_width):
+        if session in self.retry_at and time.monotonic() < self.retry_at[session]:
+            return False
+        # Printers that never connected don't know their tape yet, so they only take jobs that fit any width
+        return media_width is None or session.media_width == media_width
+
+    def acquire(self, media_width=None, timeout=None):
+        """
+        Wait for an idle printer
+
+        :param media_width: Tape width in mm the job needs, None for any
+        :param timeout: Seconds to wait, None to wait until a printer is available
+        :return: The PrinterSession, or None on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.condition:
+            while True:
+                candidates = [session for session in self.idle if self._available(session, media_width)]
+                if candidates:
+                    # Spread the work by giving the job to the printer that printed the least
+                    session = min(candidates, key=lambda candidate: self.jobs[candidate])
+                    self.idle.remove(session)
+                    self.retry_at.pop(session, None)
+                    return session
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                # Wake up regularly, out of rotation printers become available again without a release
+                self.condition.wait(min(remaining or self.retry_seconds, self.retry_seconds))
+
+    def release(self, session, failed=False):
+        """
+        Return a printer after a job
+
+        :param failed: The job failed, or the printer turned off, so take it out of rotation
+        """
+        if failed or session.socket is None:
+            self._take_out_of_rotation(session)
+
+        with self.condition:
+            self.jobs[session] += 1
+            self.idle.append(session)
+            self.condition.notify_all()
+
+    def media_widths(self):
+        """The tape widths in mm of the printers, as far as they are known"""
+        return {session.media_width for session in self.sessions if session.media_width in TZE_DOTS}
+
+    def stats(self):
+        with self.condition:
+            now = time.monotonic()
+            return {
+                session.bt_address: {
+                    'media_width': session.media_width,
+                    'jobs': self.jobs[session],
+                    'idle': session in self.idle,
+                    'in_rotation': now >= self.retry_at.get(session, 0),
+                    **session.stats(),
+                } for session in self.sessions
+            }
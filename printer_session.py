@@ -0,0 +1,215 @@
+import select
+import threading
+import time
+
+from label_commands import build_label_job, send_buffer
+from label_maker import TZE_DOTS, ConnectionState, PrinterError, connect_bluetooth, create_socket, get_printer_info, \
+    handle_status_information, make_label, make_labels, parse_status_information, \
+    receive_status_information_response, send_initialize, send_invalidate, wait_for_completion
+from label_rasterizer import DEFAULT_TRIM, trim_stats
+from label_spool import send_spool
+from printer_state import DEFAULT_STATUS_TTL, PrinterState
+
+
+class PrinterSession:
+    """
+    A long-lived connection to the printer that is reused for every label
+
+    The RFCOMM link is only (re)established when there is none yet, when the printer reported it turned off, or when
+    the link dropped while sending a job. The printer status is cached in a PrinterState and only requested again
+    when it went stale, so a job normally goes out without a status round trip.
+
+    A session owns its socket and media state, so several printers can be driven from different threads. The methods
+    lock the session, hold `lock` around a sequence of calls (e.g. reading `media_height` and then printing) that must
+    not be interleaved with other threads using the same printer.
+    """
+
+    def __init__(self, bt_address, bt_channel=1, connect_attempts=None, status_ttl=DEFAULT_STATUS_TTL):
+        """
+        :param connect_attempts: Number of connection attempts before giving up with an OSError, None to keep trying
+        :param status_ttl: Seconds the cached printer status is trusted, None to only refresh it after an event
+        """
+        self.bt_address = bt_address
+        self.bt_channel = bt_channel
+        self.connect_attempts = connect_attempts
+        self.socket = None
+        self.state = PrinterState(status_ttl)
+        self.lock = threading.RLock()
+        self.connect_count = 0
+        self.job_count = 0
+        self.last_transfer_seconds = 0.0
+        self.last_job_seconds = 0.0
+        self.total_job_seconds = 0.0
+
+    def __enter__(self):
+        self.ensure_connected()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        """Open a new RFCOMM link and query the loaded media"""
+        with self.lock:
+            self.close()
+
+            self.socket = create_socket(self.bt_address)
+            try:
+                connect_bluetooth(self.socket, self.bt_address, self.bt_channel, self.connect_attempts)
+            except OSError:
+                self.close()
+                raise
+            self.connect_count += 1
+            print(f"Connected to {self.bt_address} (connect #{self.connect_count})")
+
+            self.state.invalidate()
+            self.refresh()
+
+    def refresh(self):
+        """Request the printer status"""
+        with self.lock:
+            get_printer_info(self.socket, self.state)
+
+    @property
+    def media_width(self):
+        """Last known tape width in mm"""
+        return self.state.media_width
+
+    @property
+    def media_height(self):
+        """Number of dots that can be printed on the loaded tape"""
+        return TZE_DOTS.get(self.media_width)
+
+    def close(self):
+        with self.lock:
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
+
+    def is_healthy(self):
+        """
+        Check the link without a status round trip
+
+        The printer pushes status packets on its own (e.g. when it is turned off or the cover is opened), so any packet
+        waiting on the socket is handled and applied to the cached state here. A readable socket without data means the
+        link was closed.
+        """
+        with self.lock:
+            if self.socket is None:
+                return False
+
+            try:
+                while select.select([self.socket], [], [], 0)[0]:
+                    status_information = receive_status_information_response(self.socket)
+                    self.state.update(parse_status_information(status_information))
+                    if handle_status_information(status_information) == ConnectionState.DISCONNECTED:
+                        return False
+            except OSError as error:
+                print("Connection lost: ", error)
+                return False
+            except PrinterError as error:
+                # E.g. the cover was opened, the error flags are in the state
+                print(f"{self.bt_address}: {error}")
+                return False
+
+            return True
+
+    def ensure_connected(self):
+        """Connect if needed, and request the printer status if the cached one went stale"""
+        with self.lock:
+            if not self.is_healthy():
+                self.connect()
+            elif self.state.is_stale():
+                self.refresh()
+
+    def print_label(self, options, trim=None, conversion=None, cut=True):
+        """
+        Print the image in `options.image`, reconnecting once if the link dropped while sending
+
+        :param trim: How to trim the blank columns at both ends of the label, None to print every column
+        :param conversion: How the pixels are turned into dots, see image_conversion.Conversion
+        :param cut: Whether to cut after the label
+        :return: The ConnectionState the printer ended in
+        """
+        return self._run(lambda: make_label(options, self.socket, self.media_width, self.state, trim, conversion,
+                                            cut))
+
+    def print_labels(self, labels, chain_printing=False, trim=DEFAULT_TRIM, conversion=None):
+        """
+        Encode and print (image, cut) labels as one job, reconnecting once if the link dropped
+
+        :param trim: How to trim the blank columns at both ends of the labels, None to print every column
+        :param conversion: How the pixels are turned into dots, see image_conversion.Conversion
+        :return: The ConnectionState the printer ended in
+        """
+        return self._run(lambda: make_labels(labels, self.socket, self.media_width, chain_printing, self.state, trim,
+                                             conversion))
+
+    def print_pages(self, pages):
+        """
+        Print already compressed (RasterPayload, cut) pages as one job, reconnecting once if the link dropped
+
+        :return: The ConnectionState the printer ended in
+        """
+        return self._run(lambda: self._print_pages(pages))
+
+    def _print_pages(self, pages):
+        # Like label_maker.print_pages, timing the transfer apart from waiting for the printer
+        start = time.monotonic()
+        send_buffer(self.socket, build_label_job(pages, self.media_width).getvalue())
+        self.last_transfer_seconds = time.monotonic() - start
+        trim_stats.record_pages(pages)
+
+        return wait_for_completion(self.socket, len(pages), self.state)
+
+    def print_spool(self, spool):
+        """
+        Send a compiled Spool as is, checked against the last known tape width, reconnecting once if the link dropped
+
+        :return: The ConnectionState the printer ended in
+        :raises SpoolError: When the spool was compiled for another tape width
+        """
+        return self._run(lambda: send_spool(self.socket, spool, self.media_width, self.state))
+
+    def _run(self, job):
+        with self.lock:
+            start = time.monotonic()
+
+            try:
+                self.ensure_connected()
+                state = self._send(job)
+            except OSError as error:
+                print("Connection lost while printing: ", error, "; Reconnecting...")
+                self.connect()
+                state = self._send(job)
+
+            if state == ConnectionState.DISCONNECTED:
+                self.close()
+
+            self.last_job_seconds = time.monotonic() - start
+            self.total_job_seconds += self.last_job_seconds
+            self.job_count += 1
+            self.report()
+
+            return state
+
+    def _send(self, job):
+        send_invalidate(self.socket)
+        send_initialize(self.socket)
+        return job()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'connects': self.connect_count,
+                'jobs': self.job_count,
+                'last_job_seconds': self.last_job_seconds,
+                'average_job_seconds': self.total_job_seconds / self.job_count if self.job_count else 0.0,
+                **self.state.stats(),
+            }
+
+    def report(self):
+        stats = self.stats()
+        print(f"Job {stats['jobs']} took {stats['last_job_seconds']:.2f}s "
+              f"(average {stats['average_job_seconds']:.2f}s, {stats['connects']} connects, "
+              f"{stats['status_requests']} status requests)")
@@ -0,0 +1,285 @@
+import argparse
+import socketserver
+import threading
+import time
+
+import packbits
+
+from label_maker import STATUS_OFFSET_ERROR_INFORMATION_2, STATUS_OFFSET_MEDIA_TYPE, \
+    STATUS_OFFSET_MEDIA_WIDTH, STATUS_OFFSET_MODE, STATUS_OFFSET_NOTIFICATION_NUMBER, \
+    STATUS_OFFSET_PHASE_NUMBER, STATUS_OFFSET_PHASE_TYPE, STATUS_OFFSET_STATUS_TYPE, \
+    STATUS_OFFSET_TAPE_COLOR_INFORMATION, STATUS_OFFSET_TEXT_COLOR_INFORMATION, ErrorInformation2, MediaType, \
+    NotificationNumber, PhaseNumberEditingState, PhaseNumberPrintingState, PhaseType, StatusType, TapeColor, TextColor
+
+DEFAULT_PORT = 9100
+
+# Roughly the print speed of a PT-P710BT: 20mm/s at 180dpi
+DEFAULT_LINES_PER_SECOND = 140
+
+# Number of argument bytes following the "ESC i <command>" commands
+ESC_I_ARGUMENTS = {
+    b"a": 1,  # switch dynamic command mode
+    b"!": 1,  # switch automatic status notification mode
+    b"z": 10,  # print information
+    b"M": 1,  # various mode settings
+    b"K": 1,  # advanced mode settings
+    b"A": 1,  # specify page number in "cut each * labels"
+    b"d": 2,  # specify margin amount
+    b"S": 0,  # status information request
+}
+
+
+class SimulatedPrinter:
+    """
+    The printer side of one connection
+
+    Parses the raster command stream sent by label_maker, answers status requests, and reports printing the way a
+    PT-P710BT does: a phase change to printing, printing completed and a phase change back to editing.
+    """
+
+    def __init__(self, send, media_width=12, media_type=MediaType.LAMINATED_TAPE, tape_color=TapeColor.WHITE,
+                 text_color=TextColor.BLACK, lines_per_second=DEFAULT_LINES_PER_SECOND, status_delay=0.0,
+                 error_after=None, turn_off_after=None):
+        """
+        :param send: Callable that sends bytes to the client
+        :param media_width: Width of the simulated tape in mm
+        :param lines_per_second: Printing speed, 0 to print instantly
+        :param status_delay: Seconds to wait before answering a status request
+        :param error_after: Report an error instead of printing the page after this many pages
+        :param turn_off_after: Report the printer turned off after this many pages
+        """
+        self._send = send
+        # The notification thread and the thread reading the commands both send, whole packets at a time
+        self.send_lock = threading.Lock()
+        self.media_width = media_width
+        self.media_type = media_type
+        self.tape_color = tape_color
+        self.text_color = text_color
+        self.lines_per_second = lines_per_second
+        self.status_delay = status_delay
+        self.error_after = error_after
+        self.turn_off_after = turn_off_after
+
+        self.buffer = bytearray()
+        self.mode = 0
+        self.page_width = None
+        self.lines = []
+        self.pages = []
+        self.turned_off = False
+
+    def status(self, status_type, fields=None):
+        """
+        Build a 32 byte status packet
+
+        :param fields: Additional {offset: value} to set in the packet
+        """
+        status = bytearray(32)
+        status[0] = 0x80  # print head mark
+        status[1] = 0x20  # size
+        status[2] = 0x42  # "B"
+        status[3] = 0x30  # series code
+        status[4] = 0x76  # model code
+        status[STATUS_OFFSET_MEDIA_WIDTH] = self.media_width
+        status[STATUS_OFFSET_MEDIA_TYPE] = self.media_type
+        status[STATUS_OFFSET_MODE] = self.mode
+        status[STATUS_OFFSET_STATUS_TYPE] = status_type
+        status[STATUS_OFFSET_TAPE_COLOR_INFORMATION] = self.tape_color
+        status[STATUS_OFFSET_TEXT_COLOR_INFORMATION] = self.text_color
+
+        for offset, value in (fields or {}).items():
+            status[offset] = value
+
+        return bytes(status)
+
+    def phase_change(self, phase_type, phase_number):
+        status = bytearray(self.status(StatusType.PHASE_CHANGE, {STATUS_OFFSET_PHASE_TYPE: phase_type}))
+        status[STATUS_OFFSET_PHASE_NUMBER:STATUS_OFFSET_PHASE_NUMBER + 2] = phase_number.to_bytes(2, "big")
+        return bytes(status)
+
+    def send(self, data):
+        with self.send_lock:
+            self._send(data)
+
+    def notify(self, notification_number: NotificationNumber):
+        """Send an automatic notification, e.g. the cover was opened"""
+        self.send(self.status(StatusType.NOTIFICATION, {STATUS_OFFSET_NOTIFICATION_NUMBER: notification_number}))
+
+    def feed(self, data):
+        """Handle data received from the client"""
+        self.buffer += data
+
+        while self.buffer and not self.turned_off:
+            consumed = self.handle_command()
+            if not consumed:
+                break
+            del self.buffer[:consumed]
+
+    def handle_command(self):
+        """Handle the command at the start of the buffer, returns the number of bytes consumed or 0 if incomplete"""
+        buffer = self.buffer
+        command = buffer[0]
+
+        if command == 0x00:  # invalidate
+            return 1
+        if command == 0x5A:  # zero raster line
+            self.lines.append(bytes(16))
+            return 1
+        if command == 0x47:  # raster line
+            if len(buffer) < 3:
+                return 0
+            length = int.from_bytes(buffer[1:3], "little")
+            if len(buffer) < 3 + length:
+                return 0
+            self.lines.append(packbits.decode(bytes(buffer[3:3 + length])))
+            return 3 + length
+        if command == 0x4D:  # select compression mode
+            return 2 if len(buffer) >= 2 else 0
+        if command in (0x0C, 0x1A):  # print, print with feeding
+            self.print_page()
+            return 1
+        if command == 0x1B:
+            if len(buffer) < 2:
+                return 0
+            if buffer[1:2] == b"@":  # initialize
+                self.mode = 0
+                self.lines = []
+                return 2
+            if buffer[1:2] == b"i":
+                if len(buffer) < 3:
+                    return 0
+                subcommand = bytes(buffer[2:3])
+                if subcommand not in ESC_I_ARGUMENTS:
+                    print(f"Unknown command ESC i {subcommand!r}, skipping")
+                    return 3
+                length = 3 + ESC_I_ARGUMENTS[subcommand]
+                if len(buffer) < length:
+                    return 0
+                self.handle_esc_i(subcommand, bytes(buffer[3:length]))
+                return length
+
+        print(f"Unknown command {command:#04x}, skipping")
+        return 1
+
+    def handle_esc_i(self, subcommand, arguments):
+        if subcommand == b"S":
+            if self.status_delay:
+                time.sleep(self.status_delay)
+            self.send(self.status(StatusType.REPLY_TO_STATUS_REQUEST))
+        elif subcommand == b"z":
+            self.page_width = arguments[2]
+        elif subcommand == b"M":
+            self.mode = arguments[0]
+
+    def print_page(self):
+        lines, self.lines = self.lines, []
+        page = len(self.pages) + 1
+
+        if self.turn_off_after is not None and page > self.turn_off_after:
+            self.send(self.status(StatusType.TURNED_OFF))
+            self.turned_off = True
+            return
+
+        if self.page_width != self.media_width or (self.error_after is not None and page > self.error_after):
+            self.send(self.status(StatusType.ERROR_OCCURRED,
+                                  {STATUS_OFFSET_ERROR_INFORMATION_2: ErrorInformation2.WRONG_MEDIA}))
+            return
+
+        self.send(self.phase_change(PhaseType.PRINTING_STATE, PhaseNumberPrintingState.PRINTING))
+        if self.lines_per_second:
+            time.sleep(len(lines) / self.lines_per_second)
+        self.pages.append(lines)
+        self.send(self.status(StatusType.PRINTING_COMPLETED))
+        self.send(self.phase_change(PhaseType.EDITING_STATE, PhaseNumberEditingState.EDITING_STATE))
+
+
+class SimulatorServer(socketserver.ThreadingTCPServer):
+    """A TCP server simulating a printer for every connection"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, notify_every=None, **printer_options):
+        """
+        :param notify_every: Seconds between cover open/closed notifications, None to never send them
+        :param printer_options: Passed on to every SimulatedPrinter
+        """
+        super().__init__(address, SimulatorHandler)
+        self.notify_every = notify_every
+        self.printer_options = printer_options
+        self.printers = []
+
+    @property
+    def address(self):
+        """The printer address to pass to label_maker, e.g. "tcp:127.0.0.1:9100\""""
+        host, port = self.server_address[:2]
+        return f"tcp:{host}:{port}"
+
+    def start(self):
+        """Serve from a background thread"""
+        threading.Thread(target=self.serve_forever, name="printer-simulator", daemon=True).start()
+        return self
+
+
+class SimulatorHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        printer = SimulatedPrinter(self.request.sendall, **self.server.printer_options)
+        self.server.printers.append(printer)
+
+        connected = threading.Event()
+        connected.set()
+        if self.server.notify_every:
+            threading.Thread(target=self.notify, args=(printer, connected), daemon=True).start()
+
+        try:
+            while not printer.turned_off:
+                data = self.request.recv(65536)
+                if not data:
+                    break
+                printer.feed(data)
+        except ConnectionError:
+            # The client went away, e.g. label_maker exits as soon as printing completed
+            pass
+        finally:
+            connected.clear()
+
+    def notify(self, printer, connected):
+        """Alternately report the cover was opened and closed"""
+        notifications = [NotificationNumber.COVER_OPEN, NotificationNumber.COVER_CLOSED]
+        while True:
+            time.sleep(self.server.notify_every)
+            if not connected.is_set():
+                break
+            printer.notify(notifications[0])
+            notifications.reverse()
+
+
+def start_simulator(host="127.0.0.1", port=0, **printer_options) -> SimulatorServer:
+    """Start a simulator in the background, port 0 picks a free port"""
+    return SimulatorServer((host, port), **printer_options).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PT-P710BT simulator, use "tcp:HOST:PORT" as printer address')
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='Address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+    parser.add_argument('--media-width', type=int, default=12, help='Width of the simulated tape in mm')
+    parser.add_argument('--lines-per-second', type=float, default=DEFAULT_LINES_PER_SECOND,
+                        help='Printing speed, 0 to print instantly')
+    parser.add_argument('--status-delay', type=float, default=0.0,
+                        help='Seconds to wait before answering a status request')
+    parser.add_argument('--error-after', type=int, help='Report an error for every page after this many pages')
+    parser.add_argument('--turn-off-after', type=int, help='Report the printer turned off after this many pages')
+    parser.add_argument('--notify-every', type=float,
+                        help='Seconds between automatic cover open/closed notifications')
+    options = parser.parse_args()
+
+    server = SimulatorServer((options.host, options.port), media_width=options.media_width,
+                             lines_per_second=options.lines_per_second, status_delay=options.status_delay,
+                             error_after=options.error_after, turn_off_after=options.turn_off_after,
+                             notify_every=options.notify_every)
+    print(f"Simulating a printer with {options.media_width}mm tape on {server.address}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
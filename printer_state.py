@@ -0,0 +1,125 @@
+import threading
+import time
+
+from label_maker import NotificationNumber, StatusInformation, StatusType
+from label_rasterizer import TZE_DOTS
+
+# Seconds the last status is trusted before it is requested again
+DEFAULT_STATUS_TTL = 300
+
+# Packets sent while printing, they carry the media fields of a status reply
+REFRESHING_STATUS_TYPES = (StatusType.REPLY_TO_STATUS_REQUEST, StatusType.PRINTING_COMPLETED, StatusType.PHASE_CHANGE)
+
+
+class PrinterState:
+    """
+    The last known status of a printer, so a job doesn't need a status round trip
+
+    Every packet the printer sends has the media width and type, tape and text colours and error flags, so the state is
+    kept up to date from the packets that arrive while printing anyway. It goes stale after `ttl` seconds, or as soon as
+    something happened that could have changed the media: the cover was opened or closed, an error occurred or the
+    printer turned off. The last known values stay available, e.g. to pick a printer, until the state is refreshed.
+
+    The state is updated by the thread reading the printer and can be read from any other thread. Subscribers are
+    called with every status packet after it was applied, e.g. to follow the progress of a job.
+    """
+
+    def __init__(self, ttl=DEFAULT_STATUS_TTL):
+        """
+        :param ttl: Seconds the status is trusted, None to only refresh after an invalidating event
+        """
+        self.ttl = ttl
+        self.status = None
+        self.updated_at = None
+        self.invalidated = True
+        self.requests = 0
+        self.updates = 0
+        self.invalidations = 0
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def update(self, status: StatusInformation):
+        """Apply a status packet the printer sent"""
+        self._apply(status)
+        for subscriber in list(self.subscribers):
+            subscriber(status)
+
+    def subscribe(self, subscriber):
+        """Call `subscriber` with every status packet until it is unsubscribed"""
+        self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def _apply(self, status):
+        with self.lock:
+            self.updates += 1
+
+            if status.status_type == StatusType.REPLY_TO_STATUS_REQUEST:
+                self.requests += 1
+
+            if status.status_type in REFRESHING_STATUS_TYPES and status.media_width in TZE_DOTS:
+                self.status = status
+                self.updated_at = time.monotonic()
+                self.invalidated = False
+                return
+
+            if status.status_type == StatusType.ERROR_OCCURRED:
+                # Keep the error flags, the media fields may describe the problem (e.g. wrong media)
+                self.status = status
+                self._invalidate()
+            elif status.status_type == StatusType.TURNED_OFF:
+                self._invalidate()
+            elif status.status_type == StatusType.NOTIFICATION and status.notification_number in (
+                    NotificationNumber.COVER_OPEN, NotificationNumber.COVER_CLOSED):
+                # The tape may be swapped while the cover is open
+                self._invalidate()
+
+    def invalidate(self):
+        with self.lock:
+            self._invalidate()
+
+    def _invalidate(self):
+        if not self.invalidated:
+            self.invalidations += 1
+        self.invalidated = True
+
+    def is_stale(self):
+        """True when the status has to be requested before the next job"""
+        with self.lock:
+            if self.invalidated or self.status is None:
+                return True
+            return self.ttl is not None and time.monotonic() - self.updated_at > self.ttl
+
+    @property
+    def media_width(self):
+        """Last known tape width in mm, None if the printer never replied"""
+        return self.status.media_width if self.status is not None else None
+
+    @property
+    def media_type(self):
+        return self.status.media_type if self.status is not None else None
+
+    @property
+    def tape_color(self):
+        return self.status.tape_color if self.status is not None else None
+
+    @property
+    def text_color(self):
+        return self.status.text_color if self.status is not None else None
+
+    @property
+    def errors(self):
+        """The (ErrorInformation1, ErrorInformation2) flags of the last kept status"""
+        if self.status is None:
+            return None
+        return self.status.error_information_1, self.status.error_information_2
+
+    def stats(self):
+        with self.lock:
+            return {
+                'status_requests': self.requests,
+                'status_updates': self.updates,
+                'status_invalidations': self.invalidations,
+                'status_age_seconds': time.monotonic() - self.updated_at if self.updated_at is not None else None,
+            }
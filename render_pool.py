@@ -0,0 +1,165 @@
+import functools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from image_generator import FONT_PATH, text_to_image
+from label_rasterizer import compress, encode_image
+
+# Rendering a label takes milliseconds and printing it seconds, a few processes keep any number of printers busy
+DEFAULT_RENDER_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+
+@functools.lru_cache(maxsize=16)
+def load_template(path, mtime):
+    """A template loaded once per worker process, so its static layers are only rendered once per process"""
+    from label_templates import LabelTemplate
+
+    return LabelTemplate.load(path)
+
+
+def render_label(kind, content, height, trim=None, conversion=None, font_path=FONT_PATH, max_length=None,
+                 max_lines=None):
+    """
+    Render, encode and compress one label, in a worker process or inline
+
+    :param kind: 'text', 'image' or 'template'
+    :param content: The text, the PNG data, or the (path, modification time, field values) of a template
+    :param height: Number of dots of the tape, see TZE_DOTS
+    :param trim: How to trim the blank columns at both ends of the label, None to print every column
+    :param conversion: How the pixels of images are turned into dots, see image_conversion.Conversion
+    :return: (RasterPayload, seconds rendering, seconds encoding)
+    """
+    start = time.monotonic()
+    if kind == 'text':
+        image = text_to_image(content, height, font_path, max_length, max_lines)
+    elif kind == 'template':
+        path, mtime, values = content
+        image = load_template(path, mtime).encode(values, height)
+    else:
+        image = content
+    rendered = time.monotonic()
+
+    encoded = image.tobytes() if kind == 'template' else encode_image(image, height, conversion)
+    payload = compress(encoded, trim)
+    return payload, rendered - start, time.monotonic() - rendered
+
+
+class RenderPool:
+    """
+    Renders and encodes labels in worker processes, ahead of the printers
+
+    Jobs are handed to `prefetch` as soon as they are queued, so their labels are rendered for the tapes in the printers
+    while the printers are still busy with earlier jobs, on other cores. `render` is called when a printer is ready
+    for the job and returns the payload from the cache, from the render that is under way, or renders it right away.
+    Finished renders go into the payload cache.
+    """
+
+    def __init__(self, payload_cache, workers=DEFAULT_RENDER_WORKERS):
+        """
+        :param payload_cache: The PayloadCache rendered labels are kept in
+        :param workers: Number of worker processes, 0 to render in the calling thread when a label is needed
+        """
+        self.cache = payload_cache
+        self.workers = workers
+        self.executor = self._start() if workers else None
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.prefetched = 0
+        self.ready = 0
+        self.waited = 0
+        self.rendered = 0
+        self.wait_seconds = 0.0
+
+    def prefetch(self, key, task, timings):
+        """
+        Start rendering a label in the background, unless it is cached or already being rendered
+
+        :param key: The payload cache key of the label
+        :param task: The arguments of `render_label`
+        :param timings: Dict the render and encode seconds are stored in when done, e.g. PrintJob.timings
+        """
+        if self.executor is None:
+            return
+
+        with self.lock:
+            if key in self.in_flight or key in self.cache:
+                return
+            future = self._submit(task)
+            self.in_flight[key] = future
+            self.prefetched += 1
+
+        future.add_done_callback(lambda done: self._finish(key, done, timings))
+
+    def _start(self):
+        # Not forked, the parent has threads (MQTT, print workers) that may hold locks while forking
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _submit(self, task):
+        try:
+            return self.executor.submit(render_label, *task)
+        except BrokenProcessPool:
+            # A worker died, e.g. killed for using too much memory. Its renders failed, later ones get a new pool
+            print("Render process died, starting new render processes")
+            self.executor = self._start()
+            return self.executor.submit(render_label, *task)
+
+    def _finish(self, key, future, timings):
+        if not future.cancelled() and future.exception() is None:
+            payload, timings['render'], timings['encode'] = future.result()
+            # Cached before it is no longer in flight, so `render` finds it in one of both
+            self.cache.put(key, payload)
+        with self.lock:
+            self.in_flight.pop(key, None)
+
+    def render(self, key, task, timings):
+        """
+        The payload of a label, waiting for it if it is being rendered
+
+        Rendering errors are raised here, also those of a prefetch, e.g. ValueError for images that don't fit the tape.
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+
+        if future is None:
+            payload = self.cache.get(key)
+            if payload is not None:
+                with self.lock:
+                    self.ready += 1
+                return payload
+
+            with self.lock:
+                self.rendered += 1
+            if self.executor is None:
+                result = render_label(*task)
+            else:
+                with self.lock:
+                    future = self._submit(task)
+                result = future.result()
+        else:
+            start = time.monotonic()
+            result = future.result()
+            with self.lock:
+                self.waited += 1
+                self.wait_seconds += time.monotonic() - start
+
+        payload, timings['render'], timings['encode'] = result
+        self.cache.put(key, payload)
+        return payload
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'prefetched': self.prefetched,
+                'ready': self.ready,
+                'waited': self.waited,
+                'rendered': self.rendered,
+                'wait_seconds': self.wait_seconds,
+            }
@@ -0,0 +1,278 @@
+import functools
+import math
+import os
+import re
+from typing import NamedTuple
+
+from PIL import Image, ImageChops, ImageDraw
+
+from font_metrics import font_size
+from label_cache import LRUCache, load_font
+
+# Dots between the text and both ends of the label
+PADDING = 5
+
+# Wrapping over more lines stops before the font gets smaller than this, after that the text is shrunk to fit
+MIN_FONT_SIZE = 8
+
+DEFAULT_LINE_CACHE_SIZE = 512
+
+# The print head has 180 dots per inch
+DOTS_PER_MM = 180 / 25.4
+
+ALIGNMENT_TAG = re.compile(r'^\[(left|center|right)\]\s*')
+BOLD_MARKER = '**'
+SEPARATOR = '---'
+
+# Words and the white space between them, wrapping happens between words
+TOKEN = re.compile(r'\S+|\s+')
+
+
+class Run(NamedTuple):
+    """Part of a line drawn in one style"""
+    text: str
+    bold: bool = False
+
+
+class Line(NamedTuple):
+    runs: tuple
+    align: str = 'center'
+    separator_above: bool = False
+
+
+class Layout(NamedTuple):
+    """Lines of text with the font size and label size they were laid out for"""
+    lines: list
+    font_path: str
+    font_size: int
+    width: int
+    height: int
+
+
+def parse_markup(text):
+    """
+    Split text into lines of runs
+
+    Lines are separated by newlines, blank lines only count between other lines. `**` switches bold on and off within
+    a line, `[left]`, `[center]` or `[right]` at the start of a line aligns it (centered by default), and a line with
+    just `---` draws a separator between the lines around it.
+
+    :return: List of Line
+    """
+    lines = []
+    separator = False
+
+    # Blank lines at the start and end, e.g. the newline a message ends with, would only make the text smaller
+    for source in text.strip().split('\n'):
+        source = source.strip()
+        if source == SEPARATOR:
+            separator = True
+            continue
+
+        align = 'center'
+        match = ALIGNMENT_TAG.match(source)
+        if match:
+            align = match.group(1)
+            source = source[match.end():]
+
+        runs = tuple(Run(part, index % 2 == 1) for index, part in enumerate(source.split(BOLD_MARKER)) if part)
+        lines.append(Line(runs, align, separator and bool(lines)))
+        separator = False
+
+    return lines or [Line(())]
+
+
+@functools.lru_cache(maxsize=None)
+def bold_font_path(font_path):
+    """The bold font next to `font_path`, e.g. FreeSansBold.ttf for FreeSans.ttf, None if there is none"""
+    base, extension = os.path.splitext(font_path)
+    for candidate in (base + 'Bold', base + '-Bold', base.replace('Regular', 'Bold')):
+        if candidate != base and os.path.exists(candidate + extension):
+            return candidate + extension
+    return None
+
+
+def run_style(font_path, size, bold):
+    """The font and stroke width to draw a run with, bold is drawn with a stroke if the font has no bold variant"""
+    if not bold:
+        return load_font(font_path, size), 0
+
+    bold_path = bold_font_path(font_path)
+    if bold_path:
+        return load_font(bold_path, size), 0
+    return load_font(font_path, size), max(1, size // 20)
+
+
+@functools.lru_cache(maxsize=4096)
+def measure_run(text, bold, font_path, size):
+    """Advance width of a run in dots"""
+    font, stroke = run_style(font_path, size, bold)
+    return font.getlength(text) + 2 * stroke
+
+
+def line_width(line, font_path, size):
+    return sum(measure_run(run.text, run.bold, font_path, size) for run in line.runs)
+
+
+def wrap_line(line, font_path, size, budget):
+    """Break a line between words so that every part is at most `budget` dots wide, where possible"""
+    tokens = [Run(piece, run.bold) for run in line.runs for piece in TOKEN.findall(run.text)]
+
+    parts = []
+    current = []
+    width = 0.0
+    for token in tokens:
+        token_width = measure_run(token.text, token.bold, font_path, size)
+        if token.text.isspace():
+            if current:
+                current.append(token)
+                width += token_width
+            continue
+
+        if current and width + token_width > budget:
+            parts.append(current)
+            current = []
+            width = 0.0
+        current.append(token)
+        width += token_width
+    parts.append(current)
+
+    return [Line(merge_runs(part), line.align, line.separator_above and index == 0)
+            for index, part in enumerate(parts)]
+
+
+def merge_runs(tokens):
+    """Join tokens of the same style into runs, dropping white space at the end of the line"""
+    while tokens and tokens[-1].text.isspace():
+        tokens = tokens[:-1]
+
+    runs = []
+    for token in tokens:
+        if runs and runs[-1].bold == token.bold:
+            runs[-1] = Run(runs[-1].text + token.text, token.bold)
+        else:
+            runs.append(token)
+    return tuple(runs)
+
+
+def wrap(lines, font_path, size, budget):
+    return [part for line in lines for part in wrap_line(line, font_path, size, budget)]
+
+
+def readable_line_count(height, font_path, max_lines=None):
+    """Most lines that fit `height` dots without the font getting smaller than MIN_FONT_SIZE"""
+    count = 1
+    while (max_lines is None or count < max_lines) and font_size(font_path, height // (count + 1)) >= MIN_FONT_SIZE:
+        count += 1
+    return count
+
+
+def layout_text(text, height, font_path, max_length=None, max_lines=None) -> Layout:
+    """
+    Lay out text for a label `height` dots high
+
+    Every line gets an equal part of the height, with the font size font_metrics picks for that part. Without a
+    `max_length` the label is as long as the longest line. With one, the largest font size is used at which the text,
+    wrapped between words, fits: over more lines as long as the font stays at least MIN_FONT_SIZE (and there are no
+    more than `max_lines`), and shrunk beyond that.
+
+    :param max_length: Longest label in dots
+    :param max_lines: Most lines to wrap the text over, None for as many as MIN_FONT_SIZE allows
+    """
+    lines = parse_markup(text)
+    largest = font_size(font_path, height // len(lines))
+
+    if max_length is None:
+        return make_layout(lines, font_path, largest, height)
+
+    budget = max_length - 2 * PADDING
+    line_limit = max(len(lines), readable_line_count(height, font_path, max_lines))
+
+    def fits(size):
+        wrapped = wrap(lines, font_path, size, budget)
+        return (len(wrapped) <= line_limit and size <= font_size(font_path, height // len(wrapped)) and
+                all(line_width(line, font_path, size) <= budget for line in wrapped))
+
+    # Smaller text wraps over fewer lines, so the largest size that fits can be searched for
+    low, high = 1, largest
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle - 1
+
+    return make_layout(wrap(lines, font_path, low, budget), font_path, low, height)
+
+
+def make_layout(lines, font_path, size, height):
+    width = max(line_width(line, font_path, size) for line in lines)
+    return Layout(lines, font_path, size, math.ceil(width) + 2 * PADDING, height)
+
+
+line_cache = LRUCache(DEFAULT_LINE_CACHE_SIZE)
+
+
+def render_line(runs, font_path, size):
+    """
+    Render the runs of a line as an 'L' mask, reusing the mask of an earlier label with the same line
+
+    :return: (mask, bleed), the mask has `bleed` dots around the line's advance width and ascent + descent
+    """
+    return line_cache.get_or_create((runs, font_path, size), lambda: _render_line(runs, font_path, size))
+
+
+def _render_line(runs, font_path, size):
+    font = load_font(font_path, size)
+    ascent, descent = font.getmetrics()
+    # Room for accents above the ascender and glyphs reaching past their advance width
+    bleed = size // 4 + 1
+
+    width = sum(measure_run(run.text, run.bold, font_path, size) for run in runs)
+    mask = Image.new('L', (math.ceil(width) + 2 * bleed, ascent + descent + 2 * bleed), 0)
+    draw = ImageDraw.Draw(mask)
+
+    x = bleed
+    for run in runs:
+        run_font, stroke = run_style(font_path, size, run.bold)
+        # Draw on the baseline, so bold and regular runs line up
+        draw.text((x + stroke, bleed + ascent), run.text, font=run_font, fill=255, anchor='ls', stroke_width=stroke,
+                  stroke_fill=255)
+        x += measure_run(run.text, run.bold, font_path, size)
+
+    return mask, bleed
+
+
+def render_layout(layout: Layout) -> Image.Image:
+    """Draw a layout as a black on transparent RGBA image"""
+    mask = Image.new('L', (layout.width, layout.height), 0)
+    draw = ImageDraw.Draw(mask)
+    band = layout.height / len(layout.lines)
+    ascent, descent = load_font(layout.font_path, layout.font_size).getmetrics()
+
+    for index, line in enumerate(layout.lines):
+        if line.separator_above:
+            y = round(index * band)
+            draw.line([(PADDING, y), (layout.width - PADDING, y)], fill=255, width=max(1, layout.height // 64))
+
+        if not line.runs:
+            continue
+
+        width = line_width(line, layout.font_path, layout.font_size)
+        if line.align == 'left':
+            x = PADDING
+        elif line.align == 'right':
+            x = layout.width - PADDING - width
+        else:
+            x = (layout.width - width) / 2
+        y = index * band + (band - ascent - descent) / 2
+
+        line_mask, bleed = render_line(line.runs, layout.font_path, layout.font_size)
+        # Lines may overlap in their bleed, so combine the masks instead of pasting over each other
+        box = (round(x) - bleed, round(y) - bleed)
+        region = mask.crop(box + (box[0] + line_mask.width, box[1] + line_mask.height))
+        mask.paste(ImageChops.lighter(region, line_mask), box)
+
+    image = Image.new('RGBA', mask.size, (0, 0, 0, 0))
+    image.putalpha(mask)
+    return image